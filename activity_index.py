@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from retention_engine import rolling_frames, to_day_numbers, unique_sorted
+
+# Индекс активности: для каждого дня - битовая строка активных пользователей (np.packbits-порядок,
+# старший бит первый). Пользователи перенумерованы плотно в порядке (дата первой покупки, telegram_id),
+# поэтому когорта по дате первой покупки - непрерывный диапазон битов, и запрос по ней читает
+# только свой кусок строки. Retention любого горизонта - AND + popcount.
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(bits, axis=-1):
+        return np.bitwise_count(bits).sum(axis=axis, dtype=np.int64)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(bits, axis=-1):
+        return _POPCOUNT_TABLE[bits].sum(axis=axis, dtype=np.int64)
+
+
+MODES = ('day', 'range', 'unbounded')
+
+
+class ActivityIndex:
+    def __init__(self, user_ids, day_numbers):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        day_numbers = np.asarray(day_numbers, dtype=np.int64)
+        pairs = pd.DataFrame({'user': user_ids, 'day': day_numbers}).drop_duplicates()
+
+        first = pairs.groupby('user')['day'].min()
+        order = np.lexsort((first.index.values, first.values))
+        self.user_ids = first.index.values[order]
+        self.first_day = first.values[order]
+        self.n_users = len(self.user_ids)
+        self.min_day = int(day_numbers.min()) if len(day_numbers) else 0
+        self.n_days = int(day_numbers.max()) - self.min_day + 1 if len(day_numbers) else 0
+        self.n_bytes = (self.n_users + 7) // 8
+
+        codes = np.empty(self.n_users, dtype=np.int64)
+        codes[order] = np.arange(self.n_users)
+        user_codes = codes[np.searchsorted(first.index.values, pairs['user'].values)]
+
+        # Биты одной пары -> байт строки дня; несколько пар в одном байте объединяются через OR
+        flat = (pairs['day'].values - self.min_day) * self.n_bytes + (user_codes >> 3)
+        masks = (np.uint8(0x80) >> (user_codes & 7).astype(np.uint8)).astype(np.uint8)
+        sort = np.argsort(flat, kind='stable')
+        flat, masks = flat[sort], masks[sort]
+        starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]]) if len(flat) else np.zeros(0, np.int64)
+        self.bits = np.zeros(self.n_days * self.n_bytes, dtype=np.uint8)
+        if len(flat):
+            self.bits[flat[starts]] = np.bitwise_or.reduceat(masks, starts)
+        self.bits = self.bits.reshape(self.n_days, self.n_bytes)
+
+    @classmethod
+    def from_events(cls, events):
+        return cls(events['telegram_id'].values, to_day_numbers(events['date']))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.user_ids.nbytes + self.first_day.nbytes
+
+    def _day_offset(self, date):
+        return int(to_day_numbers([date])[0]) - self.min_day
+
+    def cohort_bounds(self, first_from=None, first_to=None):
+        # Диапазон плотных номеров пользователей с первой покупкой в [first_from, first_to]
+        lo = 0 if first_from is None else np.searchsorted(self.first_day, to_day_numbers([first_from])[0])
+        hi = self.n_users if first_to is None else np.searchsorted(self.first_day, to_day_numbers([first_to])[0],
+                                                                 side='right')
+        return int(lo), int(hi)
+
+    def user_mask(self, telegram_ids):
+        # Битовая маска произвольного набора пользователей (например, сегмента)
+        order = np.argsort(self.user_ids)
+        sorted_ids = self.user_ids[order]
+        ids = unique_sorted(np.asarray(telegram_ids, dtype=np.int64))
+        pos = np.searchsorted(sorted_ids, ids)
+        found = pos < self.n_users
+        found[found] = sorted_ids[pos[found]] == ids[found]
+        selected = np.zeros(self.n_bytes * 8, dtype=bool)
+        selected[order[pos[found]]] = True
+        return np.packbits(selected)
+
+    @staticmethod
+    def _range_mask(lo, hi, byte_lo, byte_hi):
+        # Маска битов [lo, hi) в пределах байтов [byte_lo, byte_hi)
+        selected = np.zeros((byte_hi - byte_lo) * 8, dtype=bool)
+        selected[lo - byte_lo * 8:hi - byte_lo * 8] = True
+        return np.packbits(selected)
+
+    def retention_curve(self, horizons=range(1, 366), first_from=None, first_to=None, mode='day', users=None):
+        # Когорта - пользователи с первой покупкой в [first_from, first_to] (и из users, если задан).
+        # mode='day': активен ровно на день N после своей первой покупки;
+        # 'range': вернулся в течение N дней; 'unbounded': активен на день N или позже.
+        if mode not in MODES:
+            raise ValueError(f'mode должен быть одним из {MODES}')
+        horizons = np.asarray(list(horizons), dtype=np.int64)
+        max_horizon = int(horizons.max()) if len(horizons) else 0
+        if len(horizons) and horizons.min() < 1:
+            raise ValueError('горизонты retention начинаются с 1')
+
+        lo, hi = self.cohort_bounds(first_from, first_to)
+        mask = self.user_mask(users) if users is not None else None
+
+        cohort_users = 0
+        retained = np.zeros(max_horizon + 1, dtype=np.int64)
+        cohort_days = unique_sorted(self.first_day[lo:hi]) - self.min_day
+        for day in cohort_days:
+            # Пользователи с первой покупкой в этот день - непрерывный кусок битов
+            day_lo = np.searchsorted(self.first_day, day + self.min_day)
+            day_hi = np.searchsorted(self.first_day, day + self.min_day, side='right')
+            byte_lo, byte_hi = day_lo >> 3, (day_hi + 7) >> 3
+            day_mask = self._range_mask(day_lo, day_hi, byte_lo, byte_hi)
+            if mask is not None:
+                day_mask &= mask[byte_lo:byte_hi]
+            cohort_users += popcount(day_mask)
+
+            end = self.n_days if mode == 'unbounded' else min(self.n_days, day + max_horizon + 1)
+            rows = self.bits[day + 1:end, byte_lo:byte_hi] & day_mask
+            if mode == 'range':
+                rows = np.bitwise_or.accumulate(rows, axis=0)
+            elif mode == 'unbounded':
+                rows = np.bitwise_or.accumulate(rows[::-1], axis=0)[::-1]
+            counts = popcount(rows)[:max_horizon]
+            retained[1:len(counts) + 1] += counts
+
+        retained = retained[horizons]
+        return pd.DataFrame({
+            'users': cohort_users,
+            'retained': retained,
+            'retention': retained / cohort_users * 100 if cohort_users else np.zeros(len(horizons)),
+        }, index=pd.Index(horizons, name='day'))
+
+    def rolling_retention(self, days=(1, 7, 30)):
+        # Тот же результат, что и calculate_rolling_retention, но для любых N без повторных сканов
+        active = popcount(self.bits)
+        active_days = np.flatnonzero(active)
+        retained = {}
+        for day in days:
+            counts = np.zeros(self.n_days, dtype=np.int64)
+            if day < self.n_days:
+                counts[:self.n_days - day] = popcount(self.bits[:self.n_days - day] & self.bits[day:])
+            retained[day] = counts[active_days]
+        return rolling_frames(active_days + self.min_day, active[active_days], retained, days)
+
+    def active_users(self, date):
+        day = self._day_offset(date)
+        if not 0 <= day < self.n_days:
+            return np.zeros(0, dtype=np.int64)
+        codes = np.flatnonzero(np.unpackbits(self.bits[day])[:self.n_users])
+        return np.sort(self.user_ids[codes])
@@ -0,0 +1,157 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from charts import DEFAULT_PRESET, PRESETS
+from profiling import count_rows
+from retention_analysis import RetentionAnalyzer
+from synthetic_logs import write_events
+
+# Замеры стадий RetentionAnalyzer на синтетических выгрузках разного размера.
+# Время - отдельным прогоном без tracemalloc (минимум из --repeat), пиковая память -
+# прогоном под tracemalloc (NumPy и pandas сообщают ему о своих буферах).
+STAGES = [
+    'load_data',
+    'calculate_cohort_retention',
+    'calculate_rolling_retention',
+    'calculate_repeat_purchase_rate',
+    'analyze_subscription_patterns',
+    'create_visualizations',
+]
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def _rows(value):
+    if isinstance(value, RetentionAnalyzer):
+        return len(value.df) if value.df is not None else None
+    return count_rows(value)
+
+
+def run_pipeline(path, stages, analyzer_options, trace_memory=False, preset=DEFAULT_PRESET):
+    # Стадии в порядке run_full_analysis; то, от чего зависят графики, считается всегда,
+    # но в отчет попадают только запрошенные стадии
+    results = {}
+
+    def run(stage, call):
+        if trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        value = call()
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        if stage in stages:
+            results[stage] = {'wall_s': wall, 'cpu_s': cpu, 'rows': _rows(value)}
+            if trace_memory:
+                results[stage]['peak_mb'] = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20
+        return value
+
+    analyzer = run('load_data', lambda: RetentionAnalyzer(path, use_cache=False, **analyzer_options))
+    cohort_matrix, _ = run('calculate_cohort_retention', analyzer.calculate_cohort_retention)
+    retention_data = run('calculate_rolling_retention', analyzer.calculate_rolling_retention)
+    if 'calculate_repeat_purchase_rate' in stages:
+        run('calculate_repeat_purchase_rate', analyzer.calculate_repeat_purchase_rate)
+    if 'analyze_subscription_patterns' in stages or 'create_visualizations' in stages:
+        run('analyze_subscription_patterns', analyzer.analyze_subscription_patterns)
+    if 'create_visualizations' in stages:
+        run('create_visualizations', lambda: analyzer.create_visualizations(retention_data, cohort_matrix, preset))
+    return results
+
+
+def measure(path, stages, analyzer_options, repeat, memory, preset=DEFAULT_PRESET):
+    timings = {}
+    for _ in range(repeat):
+        for stage, result in run_pipeline(path, stages, analyzer_options, preset=preset).items():
+            if stage not in timings or result['wall_s'] < timings[stage]['wall_s']:
+                timings[stage] = result
+        gc.collect()
+
+    if memory:
+        tracemalloc.start()
+        try:
+            peaks = run_pipeline(path, stages, analyzer_options, trace_memory=True, preset=preset)
+        finally:
+            tracemalloc.stop()
+        for stage, result in peaks.items():
+            timings[stage]['peak_mb'] = result['peak_mb']
+    return timings
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк стадий RetentionAnalyzer на синтетических данных')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='число событий, 1e3 .. 1e8')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='не замерять пиковую память')
+    parser.add_argument('--data-dir', default=None, help='куда складывать сгенерированные выгрузки')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--memory-budget', default=None)
+    parser.add_argument('--preset', default=DEFAULT_PRESET, choices=sorted(PRESETS), help='пресет графиков')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    analyzer_options = {'n_jobs': args.n_jobs, 'memory_budget': args.memory_budget}
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='retention_bench_')
+    os.makedirs(data_dir, exist_ok=True)
+    output = os.path.abspath(args.output)
+
+    results = []
+    # Сгенерированные выгрузки во временном каталоге удаляются, в --data-dir - остаются
+    try:
+        for size in map(int, args.sizes):
+            path = os.path.abspath(os.path.join(data_dir, f'synthetic_{size}_{args.seed}.json'))
+            if not os.path.exists(path):
+                write_events(path, size, seed=args.seed)
+            # create_visualizations сохраняет картинку в текущий каталог
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as workdir:
+                os.chdir(workdir)
+                try:
+                    timings = measure(path, args.stages, analyzer_options, args.repeat, not args.no_memory, args.preset)
+                finally:
+                    os.chdir(cwd)
+            for stage in args.stages:
+                result = dict(events=size, stage=stage, **timings[stage])
+                results.append(result)
+                peak = f"{result['peak_mb']:9.1f} MB" if 'peak_mb' in result else ''
+                print(f"{size:>11,} {stage:<32} {result['wall_s']:9.3f} s {peak}")
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'options': vars(args), 'results': results}, f,
+                  ensure_ascii=False, indent=2)
+    print(f'Результаты: {output}')
+
+
+if __name__ == "__main__":
+    main()
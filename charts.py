@@ -0,0 +1,207 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+# Отрисовка графиков отчетов. matplotlib и seaborn импортируются только при первой отрисовке
+# и всегда с неинтерактивным бэкендом Agg: без дисплея и без plt.show(). Каждый график -
+# функция panel(ax, ...) от готовых данных, фигура - набор панелей; независимые фигуры
+# (или панели при layout='panels') рисуются параллельно в пуле процессов.
+PRESETS = {
+    'draft': {'dpi': 72, 'format': 'png'},
+    'screen': {'dpi': 120, 'format': 'png'},
+    'print': {'dpi': 300, 'format': 'png'},
+    'vector': {'dpi': 300, 'format': 'svg'},
+    'pdf': {'dpi': 300, 'format': 'pdf'},
+}
+DEFAULT_PRESET = 'print'
+LAYOUTS = ('grid', 'panels')
+DOW_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    # Настройка для корректного отображения русского текста
+    plt.rcParams['font.family'] = ['DejaVu Sans', 'Arial Unicode MS', 'Tahoma']
+    plt.rcParams['axes.unicode_minus'] = False
+    return plt
+
+
+def resolve_preset(preset):
+    # Имя из PRESETS или словарь {'dpi': ..., 'format': ...} поверх 'print'
+    if isinstance(preset, dict):
+        return {**PRESETS[DEFAULT_PRESET], **preset}
+    if preset not in PRESETS:
+        raise ValueError(f'preset должен быть одним из {sorted(PRESETS)} или словарем')
+    return dict(PRESETS[preset])
+
+
+def figure(name, panels, nrows=1, ncols=1, figsize=(12, 8), title=None, style=None):
+    # panels - список (функция, kwargs) по порядку ячеек сетки nrows x ncols
+    return {'name': name, 'panels': list(panels), 'nrows': nrows, 'ncols': ncols,
+            'figsize': figsize, 'title': title, 'style': style}
+
+
+def split_panels(spec):
+    # Каждая панель фигуры - отдельный файл <name>_<номер>_<панель>
+    if len(spec['panels']) == 1:
+        return [spec]
+    width, height = spec['figsize']
+    return [
+        figure(f"{spec['name']}_{i}_{panel.__name__}", [(panel, kwargs)],
+               figsize=(width / spec['ncols'], height / spec['nrows']), style=spec['style'])
+        for i, (panel, kwargs) in enumerate(spec['panels'], 1)
+    ]
+
+
+def render_figure(task):
+    spec, options, output_dir = task
+    plt = pyplot()
+    with plt.style.context(spec['style']) if spec['style'] else nullcontext():
+        fig = plt.figure(figsize=spec['figsize'])
+        for i, (panel, kwargs) in enumerate(spec['panels'], 1):
+            panel(fig.add_subplot(spec['nrows'], spec['ncols'], i), **kwargs)
+        if spec['title']:
+            fig.suptitle(spec['title'], fontsize=16, fontweight='bold', y=0.98)
+        fig.tight_layout()
+        path = os.path.join(output_dir, f"{spec['name']}.{options['format']}")
+        fig.savefig(path, dpi=options['dpi'], format=options['format'], bbox_inches='tight')
+        plt.close(fig)
+    return path
+
+
+def _pool_context():
+    # fork не переимпортирует __main__: скрипты без main-guard (cohort_analysis.py)
+    # не выполняются в воркерах заново
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def render(figures, preset=DEFAULT_PRESET, layout='grid', n_jobs=-1, output_dir='.'):
+    if layout not in LAYOUTS:
+        raise ValueError(f'layout должен быть одним из {LAYOUTS}')
+    options = resolve_preset(preset)
+    if layout == 'panels':
+        figures = [part for spec in figures for part in split_panels(spec)]
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(spec, options, output_dir) for spec in figures]
+
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    n_jobs = min(n_jobs, len(tasks))
+    if n_jobs <= 1:
+        return [render_figure(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=_pool_context()) as pool:
+        return list(pool.map(render_figure, tasks))
+
+
+# Панели RetentionAnalyzer
+
+def retention_lines(ax, retention_data):
+    for day_key, data in retention_data.items():
+        day_num = day_key.split('_')[1]
+        ax.plot(data['date'], data[f'retention_day_{day_num}'],
+                label=f'Day {day_num}', marker='o', markersize=3)
+    ax.set_title('Динамика Retention по дням', fontsize=14, fontweight='bold')
+    ax.set_xlabel('Дата')
+    ax.set_ylabel('Retention (%)')
+    ax.legend()
+    ax.tick_params(axis='x', rotation=45)
+    ax.grid(True, alpha=0.3)
+
+
+def cohort_heatmap(ax, matrix, title, ylabel='Когорта (месяц)', xlabel='Дни с первой покупки'):
+    import seaborn as sns
+    sns.heatmap(matrix, annot=True, fmt='.1f', cmap='YlOrRd',
+                cbar_kws={'label': 'Retention (%)'}, ax=ax)
+    ax.set_title(title, fontsize=14, fontweight='bold')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+
+def weekday_bars(ax, counts, labels, total=None, color=None, rotation=0):
+    # counts - в порядке DOW_ORDER; с total над столбцами подписываются доли
+    bars = ax.bar(range(len(counts)), counts, color=color)
+    ax.set_title('Покупки по дням недели', fontsize=14, fontweight='bold')
+    ax.set_xlabel('День недели')
+    ax.set_ylabel('Количество покупок')
+    ax.set_xticks(range(len(counts)))
+    ax.set_xticklabels(labels, rotation=rotation)
+    if total:
+        for bar, count in zip(bars, counts):
+            ax.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 5,
+                    f'{count}\n({count/total*100:.1f}%)',
+                    ha='center', va='bottom', fontsize=10)
+
+
+def hourly_line(ax, counts, ticks=None, **line):
+    ax.plot(counts.index, counts.values, marker='o', **line)
+    ax.set_title('Покупки по часам дня', fontsize=14, fontweight='bold')
+    ax.set_xlabel('Час')
+    ax.set_ylabel('Количество покупок')
+    ax.grid(True, alpha=0.3)
+    if ticks is not None:
+        ax.set_xticks(ticks)
+
+
+def hour_weekday_heatmap(ax, pivot):
+    import seaborn as sns
+    sns.heatmap(pivot, cmap='YlOrRd', cbar_kws={'label': 'Количество покупок'}, ax=ax)
+    ax.set_title('Активность по дням недели и часам', fontsize=14, fontweight='bold')
+    ax.set_xlabel('Час')
+    ax.set_ylabel('День недели')
+
+
+def daily_line(ax, daily, color=None):
+    ax.plot(daily.index, daily.values, marker='o', markersize=2, color=color)
+    ax.set_title('Динамика ежедневных покупок', fontsize=14, fontweight='bold')
+    ax.set_xlabel('Дата')
+    ax.set_ylabel('Количество покупок')
+    ax.tick_params(axis='x', rotation=45)
+    ax.grid(True, alpha=0.3)
+
+
+# Панели cohort_analysis.py
+
+def purchase_pie(ax, counts, labels):
+    colors = ['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4', '#feca57']
+    ax.pie(counts, labels=labels, autopct='%1.1f%%', colors=colors, startangle=90)
+    ax.set_title('Распределение пользователей по количеству покупок', fontsize=14, fontweight='bold')
+
+
+def subscription_bars(ax, sub_stats, total):
+    sub_names = sub_stats.index
+    sub_counts = sub_stats.values
+    bars = ax.bar(range(len(sub_names)), sub_counts, color=['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4'])
+    ax.set_title('Распределение по типам подписок', fontsize=14, fontweight='bold')
+    ax.set_xlabel('Тип подписки')
+    ax.set_ylabel('Количество покупок')
+    ax.set_xticks(range(len(sub_names)))
+    ax.set_xticklabels(sub_names, rotation=45, ha='right')
+    for bar, count in zip(bars, sub_counts):
+        ax.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 5,
+                f'{count}\n({count/total*100:.1f}%)',
+                ha='center', va='bottom', fontsize=10)
+
+
+def retention_curve(ax, days, values):
+    ax.plot(days, values, marker='o', linewidth=3, markersize=8, color='#ff6b6b')
+    ax.set_title('Кривая ретеншна', fontsize=16, fontweight='bold')
+    ax.set_xlabel('Дни с первой покупки')
+    ax.set_ylabel('Retention (%)')
+    ax.set_xticks(days)
+    ax.grid(True, alpha=0.3)
+
+    # Значения на графике
+    for day, value in zip(days, values):
+        ax.annotate(f'{value:.2f}%', (day, value), textcoords="offset points",
+                    xytext=(0,10), ha='center', fontsize=12, fontweight='bold')
+
+    # Зоны качества
+    ax.axhspan(0, 5, alpha=0.2, color='red', label='Критически низкий')
+    ax.axhspan(5, 15, alpha=0.2, color='orange', label='Низкий')
+    ax.axhspan(15, 30, alpha=0.2, color='yellow', label='Средний')
+    ax.axhspan(30, 100, alpha=0.2, color='green', label='Высокий')
+    ax.legend()
@@ -1,227 +1,177 @@
-import json
+import argparse
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import numpy as np
-from datetime import datetime, timedelta
-
-# Настройка для корректного отображения русского текста
-plt.rcParams['font.family'] = ['DejaVu Sans', 'Arial Unicode MS', 'Tahoma']
-plt.rcParams['axes.unicode_minus'] = False
-
-# Загружаем данные
-with open('user_logs_paid_241024_250909.json', 'r', encoding='utf-8') as f:
-    data = json.load(f)
-
-df = pd.DataFrame(data)
-df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
-df = df.dropna(subset=['datetime'])
-df['date'] = df['datetime'].dt.date
-
-print('=== ОСНОВНАЯ СТАТИСТИКА ===')
-print(f'Общее количество записей: {len(df)}')
-print(f'Уникальных пользователей: {df["telegram_id"].nunique()}')
-print(f'Период данных: {df["date"].min()} - {df["date"].max()}')
-print(f'Среднее количество покупок на пользователя: {len(df) / df["telegram_id"].nunique():.2f}')
-
-print('\n=== АНАЛИЗ ПОВТОРНЫХ ПОКУПОК ===')
-user_purchases = df.groupby('telegram_id').size()
-print(f'Пользователей с 1 покупкой: {(user_purchases == 1).sum()} ({(user_purchases == 1).sum() / len(user_purchases) * 100:.1f}%)')
-print(f'Пользователей с 2+ покупками: {(user_purchases > 1).sum()} ({(user_purchases > 1).sum() / len(user_purchases) * 100:.1f}%)')
-print(f'Пользователей с 5+ покупками: {(user_purchases >= 5).sum()} ({(user_purchases >= 5).sum() / len(user_purchases) * 100:.1f}%)')
-
-print('\n=== АНАЛИЗ ПОДПИСОК ===')
-sub_stats = df['sub_name'].value_counts()
-for sub, count in sub_stats.items():
-    print(f'{sub}: {count} ({count/len(df)*100:.1f}%)')
-
-print('\n=== АНАЛИЗ ПО ДНЯМ НЕДЕЛИ ===')
-df['day_of_week'] = df['datetime'].dt.day_name()
-dow_stats = df['day_of_week'].value_counts()
-for day, count in dow_stats.items():
-    print(f'{day}: {count} ({count/len(df)*100:.1f}%)')
-
-print('\n=== АНАЛИЗ ПО ЧАСАМ ===')
-df['hour'] = df['datetime'].dt.hour
-hourly_stats = df['hour'].value_counts().sort_index()
-print('Топ-5 часов активности:')
-for hour, count in hourly_stats.head().items():
-    print(f'{hour:02d}:00 - {count} покупок ({count/len(df)*100:.1f}%)')
-
-print('\n=== РАСЧЕТ RETENTION ===')
-# Rolling retention calculation
-first_purchase = df.groupby('telegram_id')['date'].min().reset_index()
-first_purchase.columns = ['telegram_id', 'first_purchase_date']
-
-df_with_cohort = df.merge(first_purchase, on='telegram_id')
-df_with_cohort['days_since_first'] = (pd.to_datetime(df_with_cohort['date']) - pd.to_datetime(df_with_cohort['first_purchase_date'])).dt.days
-
-# Calculate retention for different periods
-retention_1d = 0
-retention_7d = 0
-retention_30d = 0
-
-all_dates = sorted(df['date'].unique())
-for current_date in all_dates:
-    users_today = set(df[df['date'] == current_date]['telegram_id'])
-    
-    if len(users_today) == 0:
-        continue
-    
-    # Day 1 retention
-    check_date_1d = current_date + timedelta(days=1)
-    users_check_1d = set(df[df['date'] == check_date_1d]['telegram_id'])
-    retained_1d = users_today.intersection(users_check_1d)
-    retention_1d += len(retained_1d) / len(users_today) * 100 if len(users_today) > 0 else 0
-    
-    # Day 7 retention
-    check_date_7d = current_date + timedelta(days=7)
-    users_check_7d = set(df[df['date'] == check_date_7d]['telegram_id'])
-    retained_7d = users_today.intersection(users_check_7d)
-    retention_7d += len(retained_7d) / len(users_today) * 100 if len(users_today) > 0 else 0
-    
-    # Day 30 retention
-    check_date_30d = current_date + timedelta(days=30)
-    users_check_30d = set(df[df['date'] == check_date_30d]['telegram_id'])
-    retained_30d = users_today.intersection(users_check_30d)
-    retention_30d += len(retained_30d) / len(users_today) * 100 if len(users_today) > 0 else 0
-
-print(f'Средний Retention Day 1: {retention_1d / len(all_dates):.2f}%')
-print(f'Средний Retention Day 7: {retention_7d / len(all_dates):.2f}%')
-print(f'Средний Retention Day 30: {retention_30d / len(all_dates):.2f}%')
-
-print('\n=== АНАЛИЗ КОГОРТ ===')
-df_with_cohort['cohort_month'] = pd.to_datetime(df_with_cohort['first_purchase_date']).dt.to_period('M')
-cohort_data = df_with_cohort.groupby(['cohort_month', 'days_since_first'])['telegram_id'].nunique().reset_index()
-cohort_data.columns = ['cohort_month', 'period', 'users']
-
-cohort_pivot = cohort_data.pivot(index='cohort_month', columns='period', values='users')
-cohort_pivot = cohort_pivot.fillna(0)
-
-cohort_sizes = cohort_pivot.iloc[:, 0]
-retention_matrix = cohort_pivot.div(cohort_sizes, axis=0) * 100
-
-print('Когортный анализ (последние 3 месяца):')
-print(retention_matrix.iloc[-3:].round(1))
-
-# Создаем визуализации
-fig = plt.figure(figsize=(20, 15))
-
-# 1. График повторных покупок
-ax1 = plt.subplot(2, 3, 1)
-purchase_categories = ['1 покупка', '2 покупки', '3-5 покупок', '6-10 покупок', '10+ покупок']
-purchase_counts = [
-    (user_purchases == 1).sum(),
-    ((user_purchases >= 2) & (user_purchases < 3)).sum(),
-    ((user_purchases >= 3) & (user_purchases < 6)).sum(),
-    ((user_purchases >= 6) & (user_purchases < 11)).sum(),
-    (user_purchases >= 11).sum()
-]
-colors = ['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4', '#feca57']
-wedges, texts, autotexts = ax1.pie(purchase_counts, labels=purchase_categories, autopct='%1.1f%%', 
-                                   colors=colors, startangle=90)
-ax1.set_title('Распределение пользователей по количеству покупок', fontsize=14, fontweight='bold')
-
-# 2. График подписок
-ax2 = plt.subplot(2, 3, 2)
-sub_names = sub_stats.index
-sub_counts = sub_stats.values
-bars = ax2.bar(range(len(sub_names)), sub_counts, color=['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4'])
-ax2.set_title('Распределение по типам подписок', fontsize=14, fontweight='bold')
-ax2.set_xlabel('Тип подписки')
-ax2.set_ylabel('Количество покупок')
-ax2.set_xticks(range(len(sub_names)))
-ax2.set_xticklabels(sub_names, rotation=45, ha='right')
-for i, (bar, count) in enumerate(zip(bars, sub_counts)):
-    ax2.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 5, 
-             f'{count}\n({count/len(df)*100:.1f}%)', 
-             ha='center', va='bottom', fontsize=10)
-
-# 3. График по дням недели
-ax3 = plt.subplot(2, 3, 3)
-dow_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-dow_counts_ordered = [dow_stats.get(day, 0) for day in dow_order]
-dow_labels = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-bars = ax3.bar(dow_labels, dow_counts_ordered, color='#4ecdc4')
-ax3.set_title('Покупки по дням недели', fontsize=14, fontweight='bold')
-ax3.set_xlabel('День недели')
-ax3.set_ylabel('Количество покупок')
-for i, (bar, count) in enumerate(zip(bars, dow_counts_ordered)):
-    ax3.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 5, 
-             f'{count}\n({count/len(df)*100:.1f}%)', 
-             ha='center', va='bottom', fontsize=10)
-
-# 4. График по часам
-ax4 = plt.subplot(2, 3, 4)
-hours = hourly_stats.index
-counts = hourly_stats.values
-ax4.plot(hours, counts, marker='o', linewidth=2, markersize=4, color='#45b7d1')
-ax4.set_title('Покупки по часам дня', fontsize=14, fontweight='bold')
-ax4.set_xlabel('Час')
-ax4.set_ylabel('Количество покупок')
-ax4.grid(True, alpha=0.3)
-ax4.set_xticks(range(0, 24, 2))
-
-# 5. Когортная матрица ретеншна
-ax5 = plt.subplot(2, 3, 5)
-# Берем последние 6 месяцев для лучшей визуализации
-cohort_display = retention_matrix.iloc[-6:]
-# Ограничиваем количество дней для читаемости
-cohort_display = cohort_display.iloc[:, :30]  # Первые 30 дней
-sns.heatmap(cohort_display, annot=True, fmt='.1f', cmap='YlOrRd', 
-            cbar_kws={'label': 'Retention (%)'}, ax=ax5)
-ax5.set_title('Когортный анализ ретеншна (последние 6 месяцев)', fontsize=14, fontweight='bold')
-ax5.set_xlabel('Дни с первой покупки')
-ax5.set_ylabel('Когорта (месяц)')
-
-# 6. Динамика ежедневных покупок
-ax6 = plt.subplot(2, 3, 6)
-daily_purchases = df.groupby('date').size()
-ax6.plot(daily_purchases.index, daily_purchases.values, marker='o', markersize=2, color='#96ceb4')
-ax6.set_title('Динамика ежедневных покупок', fontsize=14, fontweight='bold')
-ax6.set_xlabel('Дата')
-ax6.set_ylabel('Количество покупок')
-ax6.tick_params(axis='x', rotation=45)
-ax6.grid(True, alpha=0.3)
-
-# Добавляем общий заголовок
-fig.suptitle('Анализ ретеншна пользователей - Визуализация данных', fontsize=16, fontweight='bold', y=0.98)
-
-plt.tight_layout()
-plt.savefig('cohort_analysis_visualization.png', dpi=300, bbox_inches='tight')
-plt.show()
-
-# Дополнительная визуализация - Retention кривые
-fig2, ax = plt.subplots(figsize=(12, 8))
-
-# Создаем данные для retention кривых
-days = [1, 7, 30]
-retention_values = [retention_1d / len(all_dates), retention_7d / len(all_dates), retention_30d / len(all_dates)]
-
-ax.plot(days, retention_values, marker='o', linewidth=3, markersize=8, color='#ff6b6b')
-ax.set_title('Кривая ретеншна', fontsize=16, fontweight='bold')
-ax.set_xlabel('Дни с первой покупки')
-ax.set_ylabel('Retention (%)')
-ax.set_xticks(days)
-ax.grid(True, alpha=0.3)
-
-# Добавляем значения на график
-for i, (day, value) in enumerate(zip(days, retention_values)):
-    ax.annotate(f'{value:.2f}%', (day, value), textcoords="offset points", 
-                xytext=(0,10), ha='center', fontsize=12, fontweight='bold')
-
-# Добавляем зоны качества
-ax.axhspan(0, 5, alpha=0.2, color='red', label='Критически низкий')
-ax.axhspan(5, 15, alpha=0.2, color='orange', label='Низкий')
-ax.axhspan(15, 30, alpha=0.2, color='yellow', label='Средний')
-ax.axhspan(30, 100, alpha=0.2, color='green', label='Высокий')
-
-ax.legend()
-plt.tight_layout()
-plt.savefig('retention_curve.png', dpi=300, bbox_inches='tight')
-plt.show()
-
-print('\n=== ВИЗУАЛИЗАЦИИ СОЗДАНЫ ===')
-print('Файлы сохранены:')
-print('- cohort_analysis_visualization.png - основные графики')
-print('- retention_curve.png - кривая ретеншна')
+import charts
+from event_sources import expand_sources, load_sources, source_format, source_timezone
+from event_features import EventFeatures
+from profiling import StageProfiler, stage
+from retention_engine import (GRANULARITIES, GRANULARITY_PLURAL, GRANULARITY_SINGULAR, PERIOD_AXIS, cohort_matrices,
+                              rolling_retention)
+from retention_state import build_state_chunked
+
+parser = argparse.ArgumentParser(description='Когортный анализ и визуализация')
+parser.add_argument('data_file', nargs='*', default=['user_logs_paid_241024_250909.json'],
+                    help='файлы выгрузок, glob-шаблоны или каталоги')
+parser.add_argument('--load-jobs', type=int, default=-1,
+                    help='процессов для разбора нескольких файлов (-1 - по числу ядер)')
+parser.add_argument('--profile', metavar='TRACE_JSON', default=None,
+                    help='замерить блоки скрипта и сохранить JSON-трассу')
+parser.add_argument('--no-charts', action='store_true', help='только метрики, без графиков')
+parser.add_argument('--preset', default=charts.DEFAULT_PRESET, choices=sorted(charts.PRESETS),
+                    help='разрешение и формат графиков')
+parser.add_argument('--layout', default='grid', choices=charts.LAYOUTS,
+                    help="'panels' - каждая панель отдельным файлом")
+parser.add_argument('--cohort', default='month', choices=GRANULARITIES, help='гранулярность когорт')
+parser.add_argument('--period', default='day', choices=GRANULARITIES,
+                    help='гранулярность периодов с первой покупки')
+parser.add_argument('--max-period', type=int, default=None, help='горизонт когортной матрицы в периодах')
+parser.add_argument('--n-jobs', type=int, default=-1, help='процессов для отрисовки (-1 - по числу ядер)')
+parser.add_argument('--memory-budget', default=None,
+                    help="режим для логов больше памяти, например '512MB': таблица событий не загружается")
+args = parser.parse_args()
+if args.memory_budget is not None and (args.cohort, args.period) != ('month', 'day'):
+    # В агрегатах build_state_chunked есть только месячные когорты по дням
+    parser.error("--memory-budget поддерживает только --cohort month --period day")
+profiler = StageProfiler() if args.profile else None
+
+# Загружаем данные (потоково, сразу в типизированные колонки; повторные запуски читают кэш;
+# несколько выгрузок разбираются параллельно и сливаются без повторов по id)
+with stage(profiler, 'load_data') as record:
+    if args.memory_budget is None:
+        df = load_sources(args.data_file, n_jobs=args.load_jobs)
+        # Производные признаки (первая покупка, число покупок, день недели, час...) считаются один раз
+        features = EventFeatures(df)
+        state = None
+        n_events = len(df)
+        daily_purchases = features.daily_purchases
+    else:
+        # С --memory-budget выгрузки читаются чанками (build_state_chunked), а все ниже берется
+        # из агрегатов по пользователям, когортам и событиям
+        paths = expand_sources(args.data_file)
+        state = build_state_chunked(paths, args.memory_budget, tz=source_timezone(paths),
+                                    datetime_format=source_format(paths))
+        daily_purchases = state.daily_purchases()
+        n_events = int(daily_purchases.sum())
+    record['rows_out'] = n_events
+
+with stage(profiler, 'basic_stats', rows_in=n_events):
+    user_purchases = (features.purchase_count if state is None
+                      else pd.Series(state.purchase_count, index=pd.Index(state.user_ids, name='telegram_id')))
+    print('=== ОСНОВНАЯ СТАТИСТИКА ===')
+    print(f'Общее количество записей: {n_events}')
+    print(f'Уникальных пользователей: {len(user_purchases)}')
+    print(f'Период данных: {daily_purchases.index.min().date()} - {daily_purchases.index.max().date()}')
+    print(f'Среднее количество покупок на пользователя: {n_events / len(user_purchases):.2f}')
+
+with stage(profiler, 'repeat_purchases', rows_in=n_events) as record:
+    print('\n=== АНАЛИЗ ПОВТОРНЫХ ПОКУПОК ===')
+    print(f'Пользователей с 1 покупкой: {(user_purchases == 1).sum()} ({(user_purchases == 1).sum() / len(user_purchases) * 100:.1f}%)')
+    print(f'Пользователей с 2+ покупками: {(user_purchases > 1).sum()} ({(user_purchases > 1).sum() / len(user_purchases) * 100:.1f}%)')
+    print(f'Пользователей с 5+ покупками: {(user_purchases >= 5).sum()} ({(user_purchases >= 5).sum() / len(user_purchases) * 100:.1f}%)')
+    record['rows_out'] = len(user_purchases)
+
+if state is None:
+    sub_stats, dow_stats, hourly_stats = features.sub_stats, features.dow_stats, features.hourly_stats
+else:
+    sub_stats, dow_stats, hourly_stats = state.subscription_patterns()
+
+with stage(profiler, 'subscriptions', rows_in=n_events) as record:
+    print('\n=== АНАЛИЗ ПОДПИСОК ===')
+    for sub, count in sub_stats.items():
+        print(f'{sub}: {count} ({count/n_events*100:.1f}%)')
+    record['rows_out'] = len(sub_stats)
+
+with stage(profiler, 'day_of_week', rows_in=n_events) as record:
+    print('\n=== АНАЛИЗ ПО ДНЯМ НЕДЕЛИ ===')
+    for day, count in dow_stats.items():
+        print(f'{day}: {count} ({count/n_events*100:.1f}%)')
+    record['rows_out'] = len(dow_stats)
+
+with stage(profiler, 'hourly', rows_in=n_events) as record:
+    print('\n=== АНАЛИЗ ПО ЧАСАМ ===')
+    print('Топ-5 часов активности:')
+    for hour, count in hourly_stats.head().items():
+        print(f'{hour:02d}:00 - {count} покупок ({count/n_events*100:.1f}%)')
+    record['rows_out'] = len(hourly_stats)
+
+with stage(profiler, 'rolling_retention', rows_in=n_events) as record:
+    print('\n=== РАСЧЕТ RETENTION ===')
+    # Calculate retention for different periods (все смещения за один проход по парам пользователь-день)
+    if state is None:
+        rolling = rolling_retention(df['telegram_id'].values, features.day_numbers, days=[1, 7, 30])
+    else:
+        rolling = state.rolling_retention([1, 7, 30])
+    all_dates = rolling['day_1']['date']
+    retention_1d = rolling['day_1']['retention_day_1'].sum()
+    retention_7d = rolling['day_7']['retention_day_7'].sum()
+    retention_30d = rolling['day_30']['retention_day_30'].sum()
+
+    print(f'Средний Retention Day 1: {retention_1d / len(all_dates):.2f}%')
+    print(f'Средний Retention Day 7: {retention_7d / len(all_dates):.2f}%')
+    print(f'Средний Retention Day 30: {retention_30d / len(all_dates):.2f}%')
+    record['rows_out'] = len(all_dates)
+
+with stage(profiler, 'cohort_retention', rows_in=n_events) as record:
+    print('\n=== АНАЛИЗ КОГОРТ ===')
+    # Счетчики хранятся в длинном формате (только наблюдаемые ячейки), плотная матрица
+    # строится только для выводимых когорт
+    if state is None:
+        cohort_data = features.cohort_counts(args.cohort, args.period, args.max_period)
+    else:
+        cohort_data = state.cohort_data(args.cohort, args.period, args.max_period)
+    cohort_label = GRANULARITY_PLURAL[args.cohort]
+    retention_matrix, cohort_pivot = cohort_matrices(cohort_data, last=3)
+
+    print(f'Когортный анализ (последние 3 {dict(day="дня", week="недели", month="месяца")[args.cohort]}):')
+    print(retention_matrix.round(1))
+    record['rows_out'] = cohort_data.iloc[:, 0].nunique()
+
+# Создаем визуализации (обе фигуры рисуются параллельно, без окна)
+if not args.no_charts:
+    with stage(profiler, 'visualizations'):
+        purchase_counts = [
+            (user_purchases == 1).sum(),
+            ((user_purchases >= 2) & (user_purchases < 3)).sum(),
+            ((user_purchases >= 3) & (user_purchases < 6)).sum(),
+            ((user_purchases >= 6) & (user_purchases < 11)).sum(),
+            (user_purchases >= 11).sum()
+        ]
+        # Когортная матрица: последние 6 когорт, первые 30 периодов - для читаемости
+        cohort_display, _ = cohort_matrices(cohort_data, last=6, max_period=29)
+        main_figure = charts.figure('cohort_analysis_visualization', [
+            (charts.purchase_pie, {'counts': purchase_counts,
+                                   'labels': ['1 покупка', '2 покупки', '3-5 покупок', '6-10 покупок', '10+ покупок']}),
+            (charts.subscription_bars, {'sub_stats': sub_stats, 'total': n_events}),
+            (charts.weekday_bars, {'counts': [dow_stats.get(day, 0) for day in charts.DOW_ORDER],
+                                   'labels': ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс'],
+                                   'total': n_events, 'color': '#4ecdc4'}),
+            (charts.hourly_line, {'counts': hourly_stats, 'ticks': range(0, 24, 2),
+                                  'linewidth': 2, 'markersize': 4, 'color': '#45b7d1'}),
+            (charts.cohort_heatmap, {'matrix': cohort_display,
+                                     'title': f'Когортный анализ ретеншна (последние 6 {cohort_label})',
+                                     'ylabel': f'Когорта ({GRANULARITY_SINGULAR[args.cohort]})',
+                                     'xlabel': f'{PERIOD_AXIS[args.period]} с первой покупки'}),
+            (charts.daily_line, {'daily': daily_purchases, 'color': '#96ceb4'}),
+        ], nrows=2, ncols=3, figsize=(20, 15), title='Анализ ретеншна пользователей - Визуализация данных')
+
+        # Кривая ретеншна
+        days = [1, 7, 30]
+        retention_values = [retention_1d / len(all_dates), retention_7d / len(all_dates), retention_30d / len(all_dates)]
+        curve_figure = charts.figure('retention_curve', [
+            (charts.retention_curve, {'days': days, 'values': retention_values}),
+        ])
+
+        paths = charts.render([main_figure, curve_figure], preset=args.preset, layout=args.layout,
+                              n_jobs=args.n_jobs)
+
+    print('\n=== ВИЗУАЛИЗАЦИИ СОЗДАНЫ ===')
+    print('Файлы сохранены:')
+    descriptions = {'cohort_analysis_visualization': 'основные графики', 'retention_curve': 'кривая ретеншна'}
+    for path in paths:
+        name = os.path.basename(path)
+        description = descriptions.get(os.path.splitext(name)[0])
+        print(f'- {name} - {description}' if description else f'- {name}')
+
+if profiler is not None:
+    profiler.save(args.profile)
+    print(profiler.summary())
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from event_loader import CHUNK_SIZE, DATETIME_FORMAT, load_events
+
+# Кэш разобранных выгрузок: по каталогу на файл-источник, колонки лежат в .npy
+# и открываются через mmap, метаданные и категории - в manifest.json
+CACHE_VERSION = 1
+CACHE_DIR = os.environ.get('RETENTION_CACHE_DIR', '.retention_cache')
+MAX_ENTRIES = 8
+MAX_BYTES = 4 << 30
+HASH_BLOCK_SIZE = 8 << 20
+
+MANIFEST = 'manifest.json'
+INDEX_FILE = '__index__.npy'
+
+
+def content_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def entry_dir(path, tz, datetime_format, cache_dir):
+    # Один слот на источник и параметры разбора: новая версия файла перезаписывает старую
+    key = json.dumps([CACHE_VERSION, os.path.abspath(path), _dump_tz(tz), datetime_format])
+    return os.path.join(cache_dir, hashlib.blake2b(key.encode(), digest_size=12).hexdigest())
+
+
+def _dump_tz(tz):
+    if tz is None or isinstance(tz, str):
+        return tz
+    if isinstance(tz, timezone):
+        return {'offset': tz.utcoffset(None).total_seconds()}
+    return str(tz)
+
+
+def _load_tz(value):
+    if isinstance(value, dict):
+        return timezone(timedelta(seconds=value['offset']))
+    return value
+
+
+def _read_manifest(entry):
+    try:
+        with open(os.path.join(entry, MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(entry, manifest):
+    tmp = os.path.join(entry, MANIFEST + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(entry, MANIFEST))
+
+
+def is_valid(manifest, path):
+    # Путь и размер/mtime сверяются дешево; при расхождении только mtime
+    # (файл скопирован или "touch") решает хэш содержимого
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    stat = os.stat(path)
+    if manifest['size'] != stat.st_size:
+        return False
+    if manifest['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    if manifest['content_hash'] != content_hash(path):
+        return False
+    manifest['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+
+def save_frame(df, entry, manifest):
+    tmp = entry + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    columns = []
+    for name in df.columns:
+        series = df[name]
+        spec = {'name': name}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            spec['kind'] = 'category'
+            spec['categories'] = series.cat.categories.tolist()
+            values = series.cat.codes.values
+        elif isinstance(series.dtype, pd.DatetimeTZDtype):
+            spec['kind'] = 'datetimetz'
+            spec['unit'] = series.dtype.unit
+            spec['tz'] = _dump_tz(series.dt.tz)
+            values = series.dt.tz_convert('UTC').dt.tz_localize(None).values.view(np.int64)
+        elif series.dtype.kind == 'M':
+            spec['kind'] = 'datetime'
+            spec['unit'] = np.datetime_data(series.dtype)[0]
+            values = series.values.view(np.int64)
+        else:
+            spec['kind'] = 'array'
+            values = series.values
+        np.save(os.path.join(tmp, f'{len(columns)}.npy'), values)
+        columns.append(spec)
+    np.save(os.path.join(tmp, INDEX_FILE), df.index.values)
+
+    manifest = dict(manifest, columns=columns, rows=len(df), last_used=time.time())
+    _write_manifest(tmp, manifest)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+
+
+def load_frame(entry, manifest):
+    data = {}
+    for i, spec in enumerate(manifest['columns']):
+        values = np.load(os.path.join(entry, f'{i}.npy'), mmap_mode='r')
+        if spec['kind'] == 'category':
+            data[spec['name']] = pd.Categorical.from_codes(values, spec['categories'])
+        elif spec['kind'] == 'datetimetz':
+            utc = pd.DatetimeIndex(values.view(f"datetime64[{spec['unit']}]")).tz_localize('UTC')
+            data[spec['name']] = utc.tz_convert(_load_tz(spec['tz']))
+        elif spec['kind'] == 'datetime':
+            data[spec['name']] = values.view(f"datetime64[{spec['unit']}]")
+        else:
+            data[spec['name']] = values
+    index = np.load(os.path.join(entry, INDEX_FILE), mmap_mode='r')
+    return pd.DataFrame(data, index=pd.Index(index), copy=False)
+
+
+def _entry_size(entry):
+    try:
+        return sum(f.stat().st_size for f in os.scandir(entry))
+    except OSError:
+        return 0
+
+
+def evict(cache_dir, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, keep=()):
+    # LRU по времени последнего чтения: лишние записи и превышение общего объема.
+    # Недописанные записи (*.tmp) и записи текущей загрузки (keep) не трогаются: их может
+    # писать или читать через mmap другой процесс; max_entries - сверх записей keep, а объем
+    # считается вместе с ними, поэтому каталог ежедневных выгрузок остается в кэше целиком
+    keep = {os.path.abspath(entry) for entry in keep}
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.endswith('.tmp') or os.path.abspath(entry) in keep:
+            continue
+        manifest = _read_manifest(entry)
+        if manifest is None:
+            continue
+        entries.append((manifest.get('last_used', 0), _entry_size(entry), entry))
+
+    entries.sort(reverse=True)
+    total = sum(_entry_size(entry) for entry in keep)
+    for i, (_, size, entry) in enumerate(entries):
+        total += size
+        if i >= max_entries or ((keep or i > 0) and total > max_bytes):
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def load_events_cached(path, tz=None, chunk_size=CHUNK_SIZE, datetime_format=DATETIME_FORMAT,
+                       cache_dir=None, evict_entries=True):
+    # evict_entries=False - для воркеров пула: вытеснение выполняет родитель после загрузки всех файлов
+    cache_dir = cache_dir or CACHE_DIR
+    entry = entry_dir(path, tz, datetime_format, cache_dir)
+    manifest = _read_manifest(entry)
+
+    if is_valid(manifest, path):
+        manifest['last_used'] = time.time()
+        _write_manifest(entry, manifest)
+        return load_frame(entry, manifest)
+
+    stat = os.stat(path)
+    df = load_events(path, tz=tz, chunk_size=chunk_size, datetime_format=datetime_format)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_frame(df, entry, {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'content_hash': content_hash(path),
+    })
+    if evict_entries:
+        evict(cache_dir, keep=[entry])
+    return df
@@ -0,0 +1,129 @@
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from retention_engine import cohort_counts, from_day_numbers, to_day_numbers, unique_inverse, user_day_keys
+
+# Ленивый слой производных признаков таблицы событий: каждый признак считается при первом
+# обращении и дальше берется из кэша, поэтому первая покупка, число покупок, день недели и т.п.
+# считаются один раз на выгрузку, сколько бы метрик и графиков их ни читали.
+# Таблица не изменяется: признаки хранятся отдельно, выровненными по строкам events.
+# Изменения таблицы на месте (df.loc[...] = ...) не отслеживаются: после них нужен
+# invalidate() (RetentionAnalyzer.invalidate()), иначе отдаются прежние признаки.
+
+
+class EventFeatures:
+    def __init__(self, events):
+        self.events = events
+        self.n_events = len(events)
+
+    def matches(self, events):
+        # Признаки относятся к этой же таблице (другая таблица или длина - пересчитать);
+        # содержимое не сравнивается, см. invalidate
+        return events is self.events and len(events) == self.n_events
+
+    def invalidate(self):
+        # После изменения таблицы на месте - сбросить все посчитанные признаки
+        for name in list(vars(self)):
+            if name not in ('events', 'n_events'):
+                del self.__dict__[name]
+
+    # Признаки пользователей (индекс - telegram_id по возрастанию)
+
+    @cached_property
+    def _users(self):
+        return unique_inverse(self.events['telegram_id'].values)
+
+    @cached_property
+    def user_ids(self):
+        return pd.Index(self._users[0], name='telegram_id')
+
+    @cached_property
+    def user_codes(self):
+        # Номер пользователя в user_ids для каждого события
+        return self._users[1]
+
+    @cached_property
+    def purchase_count(self):
+        return pd.Series(self._users[2], index=self.user_ids, name='purchase_count')
+
+    @cached_property
+    def first_event(self):
+        # Позиция (iloc) первой по времени покупки каждого пользователя
+        order = np.lexsort((self.events['datetime'].values, self.user_codes))
+        codes = self.user_codes[order]
+        return order[np.r_[True, codes[1:] != codes[:-1]]] if len(codes) else order
+
+    @cached_property
+    def first_day(self):
+        first_day = np.full(len(self.user_ids), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_day, self.user_codes, self.day_numbers)
+        return first_day
+
+    @cached_property
+    def first_purchase_date(self):
+        dates = from_day_numbers(self.first_day).astype(self.events['date'].dtype)
+        return pd.Series(dates, index=self.user_ids, name='first_purchase_date')
+
+    @cached_property
+    def user_cohort_month(self):
+        return pd.Series(self.first_purchase_date.dt.to_period('M'), name='cohort_month')
+
+    # Признаки событий (выровнены по строкам events)
+
+    @cached_property
+    def day_numbers(self):
+        return to_day_numbers(self.events['date'])
+
+    @cached_property
+    def pair_keys(self):
+        # Уникальные пары пользователь-день: (keys, n_users, first_day), см. user_day_keys
+        return user_day_keys(self.events['telegram_id'].values, self.day_numbers)
+
+    @cached_property
+    def day_of_week(self):
+        return self.events['datetime'].dt.day_name().rename('day_of_week')
+
+    @cached_property
+    def hour(self):
+        return self.events['datetime'].dt.hour.rename('hour')
+
+    # Агрегаты
+
+    @cached_property
+    def _cohort_counts(self):
+        return {}
+
+    def cohort_counts(self, cohort='month', period='day', max_period=None):
+        # Уникальные пользователи по (когорта, номер периода с первой покупки) в длинном формате,
+        # по одной таблице на сочетание параметров
+        key = (cohort, period, max_period)
+        if key not in self._cohort_counts:
+            keys, n_users, first_day = self.pair_keys
+            self._cohort_counts[key] = cohort_counts(keys % n_users, keys // n_users + first_day,
+                                                     self.first_day, cohort, period, max_period)
+        return self._cohort_counts[key]
+
+    @cached_property
+    def sub_stats(self):
+        # sub_name - категориальная колонка: value_counts перечисляет и категории без событий
+        # (после фильтра subset или из других выгрузок), они отбрасываются, как в RetentionState
+        counts = self.events['sub_name'].value_counts()
+        return counts[counts > 0]
+
+    @cached_property
+    def dow_stats(self):
+        return self.day_of_week.value_counts()
+
+    @cached_property
+    def hourly_stats(self):
+        return self.hour.value_counts().sort_index()
+
+    @cached_property
+    def hour_by_day_of_week(self):
+        return pd.crosstab(self.day_of_week, self.hour)
+
+    @cached_property
+    def daily_purchases(self):
+        return self.events.groupby('date').size()
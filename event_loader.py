@@ -0,0 +1,273 @@
+import json
+import re
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+# Формат datetime по умолчанию выводится по первой записи файла, как это делал pd.to_datetime:
+# записи в другом формате (например, с дробными секундами при первой записи без них) отбрасываются,
+# как и прежде; чтобы учитывать все, передайте datetime_format='ISO8601'.
+DATETIME_FORMAT = None
+CHUNK_SIZE = 100_000
+READ_BLOCK_SIZE = 1 << 20
+
+COLUMNS = ['id', 'datetime', 'telegram_id', 'action', 'sub_name']
+CATEGORICAL_COLUMNS = ['action', 'sub_name']
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_record_blocks(path, block_size=READ_BLOCK_SIZE):
+    # Инкрементальный разбор JSON-массива: в памяти только текущий блок файла. Все целые записи
+    # блока (до последней '}') разбираются одним json.loads; если граница неудачная (вложенные
+    # объекты, '}' внутри строки), этот блок разбирается по одной записи через raw_decode
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = f.read(block_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f'{path}: ожидается JSON-массив событий')
+        pos = 1
+        eof = False
+        bulk = True
+
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            if bulk:
+                bulk = False
+                cut = buf.rfind('}', pos) + 1
+                if cut > pos:
+                    try:
+                        records = json.loads('[' + buf[pos:cut] + ']')
+                    except json.JSONDecodeError:
+                        pass
+                    else:
+                        yield records
+                        pos = cut
+                        continue
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                block = f.read(block_size)
+                eof = not block
+                buf = buf[pos:] + block
+                pos = 0
+                bulk = True
+                continue
+            yield [record]
+            pos = end
+
+
+def iter_records(path, block_size=READ_BLOCK_SIZE):
+    for records in iter_record_blocks(path, block_size):
+        yield from records
+
+
+def resolve_timezone(sample, tz=None):
+    # По умолчанию отчетная зона совпадает со смещением первой записи, как раньше
+    if tz is not None:
+        return tz
+    return pd.Timestamp(sample).tzinfo
+
+
+def resolve_format(sample, datetime_format=DATETIME_FORMAT):
+    # Явный формат - как есть, иначе выводится по записи, как в pd.to_datetime
+    if datetime_format is not None:
+        return datetime_format
+    return guess_datetime_format(sample) or 'ISO8601'
+
+
+def _digits(codes, columns):
+    # Число из цифр в заданных позициях строк (codes - коды символов, по строке на запись)
+    value = np.zeros(len(codes), dtype=np.int64)
+    for column in columns:
+        value = value * 10 + codes[:, column].astype(np.int64) - ord('0')
+    return value
+
+
+def days_from_civil(year, month, day):
+    # Номер дня от 1970-01-01 по дате григорианского календаря (векторно)
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_iso_datetimes(values):
+    # Быстрый путь для 'YYYY-MM-DDTHH:MM:SS[.ffffff]+HH:MM': разбор по позициям символов
+    # в numpy, без построчного strptime. Возвращает микросекунды UTC, признак дробных
+    # секунд и маску строк, разобранных быстрым путем (остальные - через pd.to_datetime)
+    n = len(values)
+    text = np.array([value if isinstance(value, str) else '' for value in values], dtype=str)
+    width = text.dtype.itemsize // 4
+    if n == 0 or width < 25:
+        return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=bool), np.zeros(n, dtype=bool)
+    # Коды символов без копирования; в int64 переводятся только нужные позиции
+    codes = text.view(np.uint32).reshape(n, width)
+    length = (codes != 0).sum(axis=1)
+    rows = np.arange(n)
+
+    def char_at(offset):
+        return codes[rows, np.clip(length + offset, 0, width - 1)].astype(np.int64)
+
+    def is_digit(chars):
+        return (chars >= ord('0')) & (chars <= ord('9'))
+
+    ok = length >= 25
+    for column, char in ((4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':')):
+        ok &= codes[:, column] == ord(char)
+    for column in (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18):
+        ok &= is_digit(codes[:, column])
+
+    # Смещение '+HH:MM' в конце строки
+    sign = char_at(-6)
+    ok &= ((sign == ord('+')) | (sign == ord('-'))) & (char_at(-3) == ord(':'))
+    for offset in (-5, -4, -2, -1):
+        ok &= is_digit(char_at(offset))
+    offset_minutes = ((char_at(-5) - ord('0')) * 10 + char_at(-4) - ord('0')) * 60 + \
+        (char_at(-2) - ord('0')) * 10 + char_at(-1) - ord('0')
+    offset_minutes = np.where(sign == ord('-'), -offset_minutes, offset_minutes)
+
+    # Дробная часть: '.' и 1-6 цифр между секундами и смещением
+    fraction_digits = length - 6 - 20
+    fractional = length > 25
+    ok &= ~fractional | ((codes[:, 19] == ord('.')) & (fraction_digits >= 1) & (fraction_digits <= 6))
+    micros = np.zeros(n, dtype=np.int64)
+    for k in range(6):
+        column = codes[:, min(20 + k, width - 1)].astype(np.int64)
+        present = fractional & (k < fraction_digits)
+        ok &= ~present | is_digit(column)
+        micros += np.where(present, column - ord('0'), 0) * 10 ** (5 - k)
+
+    year, month, day = _digits(codes, (0, 1, 2, 3)), _digits(codes, (5, 6)), _digits(codes, (8, 9))
+    hour, minute, second = _digits(codes, (11, 12)), _digits(codes, (14, 15)), _digits(codes, (17, 18))
+    month_days = days_from_civil(year + (month == 12), np.where(month == 12, 1, month + 1), 1) - \
+        days_from_civil(year, np.clip(month, 1, 12), 1)
+    ok &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days)
+    # Годы вне диапазона pd.Timestamp в наносекундах - на усмотрение pandas
+    ok &= (year >= 1678) & (year <= 2261)
+    ok &= (hour < 24) & (minute < 60) & (second < 60) & (offset_minutes > -24 * 60) & (offset_minutes < 24 * 60)
+
+    seconds = days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second - offset_minutes * 60
+    return np.where(ok, seconds * 1_000_000 + micros, 0), fractional, ok
+
+
+def parse_datetimes(values, datetime_format):
+    # Колонка datetime -> UTC (datetime64[us]); строки не в формате datetime_format - NaT,
+    # как pd.to_datetime(..., format=datetime_format, errors='coerce')
+    fractional_formats = {'%Y-%m-%dT%H:%M:%S%z': False, '%Y-%m-%dT%H:%M:%S.%f%z': True, 'ISO8601': None}
+    if datetime_format not in fractional_formats:
+        return pd.to_datetime(pd.Series(values, dtype=object), format=datetime_format,
+                              errors='coerce', utc=True).dt.as_unit('us')
+
+    micros, fractional, ok = parse_iso_datetimes(values)
+    expected = fractional_formats[datetime_format]
+    if expected is not None:
+        # Прежнее поведение: записи с дробными секундами при формате без них (и наоборот) отбрасываются
+        ok &= fractional == expected
+    result = micros.astype('datetime64[us]')
+    result[~ok] = np.datetime64('NaT')
+    rest = np.flatnonzero(~ok)
+    if len(rest):
+        # Необычные записи ('Z', '+0300', больше 6 знаков дроби и т.п.) - как раньше
+        other = pd.to_datetime(pd.Series([values[i] for i in rest], dtype=object), format=datetime_format,
+                               errors='coerce', utc=True)
+        result[rest] = other.dt.tz_localize(None).values.astype('datetime64[us]')
+    return pd.Series(result).dt.tz_localize('UTC')
+
+
+def _int_column(values, name):
+    # id и telegram_id - int64; null или нечисловое значение - понятная ошибка вместо TypeError numpy
+    try:
+        return np.array(values, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        for value in values:
+            try:
+                np.int64(value)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError(f'в выгрузке есть запись с {name}={value!r}: ожидается целое число') from None
+        raise
+
+
+def build_frame(columns, tz, datetime_format=DATETIME_FORMAT):
+    # Списки значений одного чанка -> типизированные колонки
+    dt = parse_datetimes(columns['datetime'], datetime_format)
+    return pd.DataFrame({
+        'id': _int_column(columns['id'], 'id'),
+        'datetime': dt.dt.tz_convert(tz),
+        'telegram_id': _int_column(columns['telegram_id'], 'telegram_id'),
+        'action': pd.Categorical(columns['action']),
+        'sub_name': pd.Categorical(columns['sub_name']),
+    })
+
+
+def iter_event_chunks(path, chunk_size=CHUNK_SIZE, tz=None, datetime_format=DATETIME_FORMAT,
+                      block_size=READ_BLOCK_SIZE):
+    # Чанки по целым блокам файла: в чанке от chunk_size записей (плюс не больше одного блока)
+    pending = []
+    size = 0
+    resolved = False
+    for records in iter_record_blocks(path, block_size):
+        if not resolved:
+            sample = next((record['datetime'] for record in records if record.get('datetime')), None)
+            if sample is not None:
+                # Формат и зона - по первой записи файла
+                datetime_format = resolve_format(sample, datetime_format)
+                tz = resolve_timezone(sample, tz)
+                resolved = True
+        pending.append(records)
+        size += len(records)
+        if size >= chunk_size:
+            yield _chunk_frame(pending, tz, datetime_format)
+            pending = []
+            size = 0
+
+    if size:
+        yield _chunk_frame(pending, tz, datetime_format)
+
+
+def _chunk_frame(blocks, tz, datetime_format):
+    records = [record for block in blocks for record in block]
+    try:
+        # Одним проходом по записям: кортежи полей и транспонирование в колонки
+        values = zip(*map(itemgetter(*COLUMNS), records))
+        columns = dict(zip(COLUMNS, map(list, values)))
+    except KeyError:
+        # В выгрузке есть записи без части полей - они становятся None
+        columns = {name: [record.get(name) for record in records] for name in COLUMNS}
+    return build_frame(columns, tz or 'UTC', datetime_format)
+
+
+def concat_chunks(chunks):
+    # Общий набор категорий для всех чанков, чтобы concat не переводил колонки в object
+    chunks = list(chunks)
+    if not chunks:
+        return build_frame({name: [] for name in COLUMNS}, 'UTC')
+    for name in CATEGORICAL_COLUMNS:
+        categories = sorted(set().union(*(chunk[name].cat.categories for chunk in chunks)))
+        for chunk in chunks:
+            chunk[name] = chunk[name].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def add_dates(df):
+    df = df.dropna(subset=['datetime'])
+    df['date'] = df['datetime'].dt.tz_localize(None).dt.normalize()
+    return df
+
+
+def finalize_events(df):
+    return add_dates(df).sort_values('datetime')
+
+
+def load_events(path, tz=None, chunk_size=CHUNK_SIZE, datetime_format=DATETIME_FORMAT):
+    # Потоковая загрузка: пиковая память ~ итоговая таблица + один чанк сырых записей
+    chunks = iter_event_chunks(path, chunk_size=chunk_size, tz=tz, datetime_format=datetime_format)
+    return finalize_events(concat_chunks(chunks))
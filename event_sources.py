@@ -0,0 +1,124 @@
+import glob
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from event_cache import CACHE_DIR, entry_dir, evict, load_events_cached
+from event_loader import DATETIME_FORMAT, concat_chunks, iter_records, load_events, resolve_format, resolve_timezone
+
+# Несколько выгрузок user_logs_paid_<start>_<end>.json как один источник: путь к файлу,
+# glob-шаблон, каталог или список из них. Файлы разбираются параллельно в пуле процессов
+# (каждый - через кэш event_cache), таблицы сливаются в порядке файлов, а события из
+# пересекающихся окон выгрузок (одинаковый id) остаются один раз.
+SOURCE_PATTERN = 'user_logs_paid_*.json'
+GLOB_CHARS = '*?['
+
+
+def expand_sources(data):
+    # Список файлов: каталог -> выгрузки в нем по имени, шаблон -> совпадения по имени,
+    # список - в заданном порядке; повторяющиеся пути отбрасываются
+    if isinstance(data, (str, os.PathLike)):
+        data = [data]
+    paths = []
+    for item in data:
+        item = os.fspath(item)
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, SOURCE_PATTERN)))
+        elif any(char in item for char in GLOB_CHARS):
+            matches = sorted(path for path in glob.glob(item) if os.path.isfile(path))
+        else:
+            matches = [item]
+        if not matches:
+            raise FileNotFoundError(f'{item}: не найдено ни одной выгрузки')
+        paths.extend(matches)
+
+    seen = set()
+    unique = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique
+
+
+def _first_datetime(paths):
+    for record in iter_records(paths[0]):
+        if record.get('datetime'):
+            return record['datetime']
+    return None
+
+
+def source_timezone(paths, tz=None, datetime_format=DATETIME_FORMAT):
+    # Одна отчетная зона на все файлы: заданная или смещение первой записи первого файла
+    # (иначе каждая выгрузка взяла бы свою, и колонка date разъехалась бы)
+    if tz is not None or len(paths) < 2:
+        return tz
+    sample = _first_datetime(paths)
+    return tz if sample is None else resolve_timezone(sample)
+
+
+def source_format(paths, datetime_format=DATETIME_FORMAT):
+    # Так же один формат datetime на все файлы: выведенный по записи каждого файла отдельно
+    # мог бы отбрасывать в одной выгрузке записи, которые другая разбирает
+    if datetime_format is not None or len(paths) < 2:
+        return datetime_format
+    sample = _first_datetime(paths)
+    return datetime_format if sample is None else resolve_format(sample)
+
+
+def _load_source(args):
+    path, tz, use_cache, datetime_format = args
+    if use_cache:
+        # Вытеснение из общего каталога кэша - только в родителе, после загрузки всех файлов
+        return load_events_cached(path, tz=tz, datetime_format=datetime_format, evict_entries=False)
+    return load_events(path, tz=tz, datetime_format=datetime_format)
+
+
+def merge_events(frames):
+    # Таблицы в порядке файлов -> одна таблица; при повторе id остается первое вхождение
+    events = concat_chunks(frames)
+    events = events.drop_duplicates(subset='id', keep='first')
+    return events.sort_values('datetime', kind='stable')
+
+
+def load_sources(data, tz=None, use_cache=True, n_jobs=-1, datetime_format=DATETIME_FORMAT):
+    paths = expand_sources(data)
+    if len(paths) == 1:
+        return _load_source((paths[0], tz, use_cache, datetime_format))
+
+    tz = source_timezone(paths, tz, datetime_format)
+    datetime_format = source_format(paths, datetime_format)
+    tasks = [(path, tz, use_cache, datetime_format) for path in paths]
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    n_jobs = min(n_jobs, len(paths))
+    if n_jobs == 1:
+        frames = [_load_source(task) for task in tasks]
+    else:
+        # Порядок результатов pool.map совпадает с порядком файлов; fork - чтобы воркеры не
+        # выполняли заново вызывающий скрипт (cohort_analysis.py без main-guard)
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as pool:
+            frames = list(pool.map(_load_source, tasks))
+    if use_cache and os.path.isdir(CACHE_DIR):
+        evict(CACHE_DIR, keep=[entry_dir(path, tz, datetime_format, CACHE_DIR) for path in paths])
+    return merge_events(frames)
+
+
+def drop_seen(chunk, seen):
+    # Для потоковых режимов: события чанка, id которых уже встречались в предыдущих файлах
+    # (seen - отсортированный массив id)
+    if len(seen) == 0:
+        return chunk
+    pos = np.searchsorted(seen, chunk['id'].values)
+    found = pos < len(seen)
+    found[found] = seen[pos[found]] == chunk['id'].values[found]
+    return chunk[~found]
+
+
+def add_seen(seen, ids):
+    # Оба массива отсортированы, устойчивая сортировка сливает их за линейное время
+    ids = np.sort(np.asarray(ids, dtype=np.int64))
+    return np.sort(np.concatenate([seen, ids]), kind='stable')
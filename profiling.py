@@ -0,0 +1,89 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+# Инструментирование стадий анализа: время (wall/CPU), пиковая и оставшаяся после стадии
+# память (tracemalloc), строки на входе и выходе. Включается передачей StageProfiler;
+# без него стадии выполняются напрямую, без накладных расходов.
+
+
+def count_rows(value):
+    if isinstance(value, tuple):
+        value = value[0]
+    if isinstance(value, dict):
+        return sum(len(item) for item in value.values() if hasattr(item, '__len__'))
+    if value is None or not hasattr(value, '__len__'):
+        return None
+    return len(value)
+
+
+class StageProfiler:
+    def __init__(self, trace_memory=True, hooks=()):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks)
+        self.records = []
+        self.started_at = datetime.now(timezone.utc).isoformat()
+
+    def add_hook(self, callback):
+        # callback(record) вызывается после каждой стадии, например для отправки в мониторинг
+        self.hooks.append(callback)
+        return callback
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        own_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if own_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start_wall
+            record['cpu_s'] = time.process_time() - start_cpu
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record['peak_mb'] = (peak - baseline) / 2 ** 20
+                record['retained_mb'] = (current - baseline) / 2 ** 20
+            if own_tracing:
+                tracemalloc.stop()
+            self.records.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def run(self, name, call, *args, rows_in=None):
+        with self.stage(name, rows_in=rows_in) as record:
+            result = call(*args)
+            record['rows_out'] = count_rows(result)
+        return result
+
+    def to_dict(self):
+        return {
+            'started_at': self.started_at,
+            'trace_memory': self.trace_memory,
+            'total_wall_s': sum(record['wall_s'] for record in self.records),
+            'stages': self.records,
+        }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def summary(self):
+        lines = []
+        for record in self.records:
+            memory = f" {record['peak_mb']:9.1f} MB" if 'peak_mb' in record else ''
+            lines.append(f"{record['stage']:<32} {record['wall_s']:9.3f} s{memory}")
+        return '\n'.join(lines)
+
+
+def stage(profiler, name, rows_in=None):
+    # Для блоков скрипта: with stage(profiler, 'name') as record: ...
+    if profiler is None:
+        return nullcontext({})
+    return profiler.stage(name, rows_in=rows_in)
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+# Продления с учетом срока подписки. Каждая покупка покрывает plan_days дней (из sub_name:
+# '30 дней' -> 30); покупка до окончания текущего срока продлевает его с конца, как в биллинге.
+# Конец покрытия сопоставляется со следующей покупкой того же пользователя as-of join-ом:
+# searchsorted по массиву, отсортированному по (пользователь, время), - O(n log n), без циклов
+# по пользователям. Статусы: 'on_time' - следующая покупка до конца покрытия, 'grace' - в течение
+# grace_days после него, 'churned' - окно прошло без покупки, 'open' - окно еще не закрыто.
+GRACE_DAYS = 7
+STATUSES = ('on_time', 'grace', 'churned', 'open')
+SECONDS_PER_DAY = 86400
+
+
+def plan_days(sub_names):
+    # Длина тарифа в днях; категории разбираются один раз, а не каждая строка
+    plans = pd.Categorical(sub_names)
+    days = pd.Series(plans.categories.astype(str)).str.extract(r'(\d+)', expand=False).astype(float)
+    unknown = plans.categories[days.isna().values]
+    if len(unknown) or (plans.codes < 0).any():
+        raise ValueError(f'не удалось определить срок подписки: {list(unknown) or "пустой sub_name"}')
+    return days.values.astype(np.int64)[plans.codes]
+
+
+def _to_time(seconds, tz):
+    return pd.to_datetime(seconds, unit='s', utc=True).tz_convert(tz)
+
+
+def renewal_events(features, grace_days=GRACE_DAYS, observed_until=None):
+    # Одна строка на покупку (в порядке пользователь, время): конец покрытия, следующая покупка и статус
+    events = features.events
+    seconds = events['datetime'].values.astype('datetime64[s]').astype(np.int64)
+    order = np.lexsort((seconds, features.user_codes))
+    codes, seconds = features.user_codes[order], seconds[order]
+    duration = plan_days(events['sub_name'].values[order]) * SECONDS_PER_DAY
+
+    # end_i = max(t_i, end_{i-1}) + d_i  =>  end_i = S_i + max_{k<=i}(t_k - S_{k-1}),
+    # где S - накопленная по пользователю длительность: групповые cumsum и cummax
+    total = pd.Series(duration).groupby(codes).cumsum().values
+    coverage_end = total + pd.Series(seconds - (total - duration)).groupby(codes).cummax().values
+
+    # Следующая покупка - первая строка с ключом (пользователь, время) строго больше текущего
+    n = len(seconds)
+    base = int(seconds.min()) if n else 0
+    span = int(seconds.max()) - base + 1 if n else 1
+    composite = codes * span + (seconds - base)
+    following = np.searchsorted(composite, composite, side='right')
+    has_next = following < n
+    has_next[has_next] = codes[following[has_next]] == codes[has_next]
+    next_purchase = np.where(has_next, seconds[np.minimum(following, n - 1)], 0)
+
+    if observed_until is None:
+        observed_until = int(seconds.max()) if n else 0
+    else:
+        observed_until = int(pd.Timestamp(observed_until).timestamp())
+    grace = int(grace_days * SECONDS_PER_DAY)
+    on_time = has_next & (next_purchase <= coverage_end)
+    in_grace = has_next & ~on_time & (next_purchase <= coverage_end + grace)
+    churned = ~on_time & ~in_grace & (has_next | (coverage_end + grace <= observed_until))
+    status = np.select([on_time, in_grace, churned], [0, 1, 2], default=3)
+
+    tz = events['datetime'].dt.tz
+    return pd.DataFrame({
+        'telegram_id': features.user_ids.values[codes],
+        'datetime': _to_time(seconds, tz),
+        'sub_name': events['sub_name'].values[order],
+        'cohort_month': features.user_cohort_month.array[codes],
+        'plan_days': duration // SECONDS_PER_DAY,
+        'coverage_end': _to_time(coverage_end, tz),
+        'next_purchase': _to_time(next_purchase, tz).where(has_next),
+        'renewal_lag_days': np.where(has_next, (next_purchase - coverage_end) / SECONDS_PER_DAY, np.nan),
+        'status': pd.Categorical.from_codes(status, STATUSES),
+    })
+
+
+def renewal_rates(renewals, by=('cohort_month', 'sub_name')):
+    # Число покупок по статусам и доли от закрытых окон (on_time + grace + churned)
+    counts = pd.crosstab([renewals[key] for key in by], renewals['status'], dropna=False)
+    counts = counts.reindex(columns=list(STATUSES), fill_value=0)
+    counts.columns = list(STATUSES)
+    counts = counts[counts.sum(axis=1) > 0]
+    resolved = counts[['on_time', 'grace', 'churned']].sum(axis=1)
+
+    table = counts.copy()
+    table['resolved'] = resolved
+    for status in ('on_time', 'grace', 'churned'):
+        table[f'{status}_rate'] = (counts[status] / resolved.where(resolved > 0) * 100)
+    table['renewal_rate'] = table['on_time_rate'] + table['grace_rate']
+    return table
@@ -1,172 +1,236 @@
-import json
+import argparse
+import copy
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from datetime import datetime, timedelta
-from collections import defaultdict
 import warnings
+from activity_index import ActivityIndex
+import charts
+from event_features import EventFeatures
+from event_sources import expand_sources, load_sources, source_format, source_timezone
+from profiling import StageProfiler
+from renewals import GRACE_DAYS, renewal_events, renewal_rates
+from retention_engine import (GRANULARITIES, GRANULARITY_PLURAL, GRANULARITY_SINGULAR, PERIOD_AXIS, categorize_purchases,
+                              cohort_matrices, rolling_retention)
+from retention_state import BUDGET_SHARE, DEFAULT_DAYS, build_state, build_state_chunked, chunk_sizes, parse_size
+from segments import segmented_retention
+from sketches import DEFAULT_PRECISION, build_cohort_sketch, build_cohort_sketch_chunked
 warnings.filterwarnings('ignore')
 
-plt.rcParams['font.family'] = ['DejaVu Sans', 'Arial Unicode MS', 'Tahoma']
-plt.rcParams['axes.unicode_minus'] = False
-
 class RetentionAnalyzer:
-    def __init__(self, data_file):
+    def __init__(self, data_file, tz=None, use_cache=True, n_jobs=1, memory_budget=None, profiler=None,
+                 approximate=False, sketch_precision=DEFAULT_PRECISION, load_jobs=-1):
+        # data_file - файл, glob-шаблон, каталог с выгрузками или список из них (event_sources.py)
         self.data_file = data_file
-        self.data = None
+        self.data_files = expand_sources(data_file)
+        self.tz = tz
+        self.load_jobs = load_jobs
+        self.use_cache = use_cache
+        self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+        self.profiler = profiler
+        self.approximate = approximate
+        self.sketch_precision = sketch_precision
+        self.sketch = None
         self.df = None
-        self.load_data()
+        self.state = None
+        self._features = None
+        self._run_stage('load_data', self.load_data)
     
     def load_data(self):
-        with open(self.data_file, 'r', encoding='utf-8') as f:
-            self.data = json.load(f)
-        
-        self.df = pd.DataFrame(self.data)
-        self.df['datetime'] = pd.to_datetime(self.df['datetime'], errors='coerce')
-        self.df = self.df.dropna(subset=['datetime'])
-        self.df['date'] = self.df['datetime'].dt.date
-        self.df = self.df.sort_values('datetime')
-    
-    def calculate_cohort_retention(self):
-        first_purchase = self.df.groupby('telegram_id')['date'].min().reset_index()
-        first_purchase.columns = ['telegram_id', 'first_purchase_date']
-        
-        df_with_cohort = self.df.merge(first_purchase, on='telegram_id')
-        df_with_cohort['days_since_first'] = (pd.to_datetime(df_with_cohort['date']) - pd.to_datetime(df_with_cohort['first_purchase_date'])).dt.days
-        df_with_cohort['cohort_month'] = pd.to_datetime(df_with_cohort['first_purchase_date']).dt.to_period('M')
-        
-        cohort_data = df_with_cohort.groupby(['cohort_month', 'days_since_first'])['telegram_id'].nunique().reset_index()
-        cohort_data.columns = ['cohort_month', 'period', 'users']
+        self.state = None
+        self.sketch = None
+        self._features = None
+        if self.memory_budget is not None:
+            # Режим с ограниченной памятью: таблица событий целиком не загружается,
+            # все метрики берутся из агрегатов, собранных потоково (build_state_chunked)
+            self.df = None
+        else:
+            # Несколько файлов разбираются параллельно (load_jobs процессов), события с одинаковым id - один раз
+            self.df = load_sources(self.data_files, tz=self.tz, use_cache=self.use_cache, n_jobs=self.load_jobs)
+        return self.df
+    
+    @property
+    def source_tz(self):
+        # Отчетная зона для потоковых режимов - общая для всех файлов, как в load_sources
+        return source_timezone(self.data_files, self.tz)
+    
+    @property
+    def source_format(self):
+        # И формат datetime - один на все файлы (load_sources выводит его так же)
+        return source_format(self.data_files)
+    
+    def _run_stage(self, name, method, *args):
+        # Без профилировщика - прямой вызов; с ним - время, память и строки стадии
+        if self.profiler is None:
+            return method(*args)
+        rows_in = len(self.df) if self.df is not None else None
+        return self.profiler.run(name, method, *args, rows_in=rows_in)
+    
+    @property
+    def features(self):
+        # Производные признаки считаются один раз на таблицу и пересоздаются при ее замене
+        if self._features is None or not self._features.matches(self.df):
+            self._features = EventFeatures(self.df)
+        return self._features
+    
+    def invalidate(self):
+        # После изменения self.df на месте: признаки, состояние и скетчи считаются заново
+        # (замена self.df целиком замечается сама)
+        if self._features is not None:
+            self._features.invalidate()
+        self.state = None
+        self.sketch = None
+    
+    def subset(self, start=None, end=None, **columns):
+        # Анализатор над частью событий без повторной загрузки: даты [start, end] (по колонке date,
+        # таблица отсортирована по времени - бинарный поиск) и значения колонок, например sub_name=[...]
+        if self.df is None:
+            raise ValueError('выборка строится по таблице событий и недоступна при memory_budget')
+        events = self.df
+        dates = events['date'].values
+        lo = np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), side='left') if start is not None else 0
+        hi = np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), side='right') if end is not None else len(events)
+        events = events.iloc[lo:hi]
+        for name, values in columns.items():
+            if name not in events.columns:
+                raise ValueError(f'неизвестная колонка фильтра {name!r}')
+            if isinstance(values, (str, int)):
+                values = [values]
+            events = events[events[name].isin(values)]
         
-        cohort_pivot = cohort_data.pivot(index='cohort_month', columns='period', values='users')
-        cohort_pivot = cohort_pivot.fillna(0)
+        subset = copy.copy(self)
+        subset.df = events
+        subset.state = None
+        subset.sketch = None
+        subset._features = None
+        return subset
+    
+    @property
+    def uses_state(self):
+        return self.n_jobs != 1 or self.memory_budget is not None
+    
+    def _aggregate_state(self, days=DEFAULT_DAYS):
+        # При n_jobs != 1 когорты, покупки и retention считаются по партициям telegram_id
+        # в пуле процессов, при memory_budget - по партициям, сброшенным на диск;
+        # одно состояние обслуживает все методы
+        if self.state is None or not set(days) <= set(self.state.days):
+            days = sorted(set(days) | set(self.state.days if self.state is not None else ()))
+            if self.memory_budget is not None:
+                self.state = build_state_chunked(self.data_files, self.memory_budget, days=days, tz=self.source_tz,
+                                                 datetime_format=self.source_format)
+            else:
+                self.state = build_state(self.df, days=days, n_jobs=self.n_jobs, tz=self.tz)
+        return self.state
+    
+    def build_cohort_sketch(self):
+        # HyperLogLog-скетчи ячеек когорт и дней: фиксированная память на ячейку, ошибка sketch.error
+        if self.sketch is None:
+            if self.df is None:
+                # Чанк и блок чтения - из бюджета, как в build_state_chunked: половина рабочей
+                # памяти на сырые записи, остальное - первые дни пользователей и скетчи
+                chunk_size, block_size = chunk_sizes(int(parse_size(self.memory_budget) * BUDGET_SHARE) // 2)
+                self.sketch = build_cohort_sketch_chunked(self.data_files, self.sketch_precision, tz=self.source_tz,
+                                                          datetime_format=self.source_format,
+                                                          chunk_size=chunk_size, block_size=block_size)
+            else:
+                self.sketch = build_cohort_sketch(self.df, self.sketch_precision, n_jobs=self.n_jobs)
+        return self.sketch
+    
+    def calculate_cohort_counts(self, cohort='month', period='day', max_period=None):
+        # Длинная таблица (когорта, period, users) - только наблюдаемые ячейки
+        if self.approximate:
+            self._check_sketch_granularity(cohort)
+            return self.build_cohort_sketch().cohort_data(period=period, max_period=max_period)
+        if self.uses_state:
+            return self._aggregate_state().cohort_data(cohort, period, max_period)
         
-        cohort_sizes = cohort_pivot.iloc[:, 0]
-        retention_matrix = cohort_pivot.div(cohort_sizes, axis=0) * 100
+        return self.features.cohort_counts(cohort, period, max_period)
+    
+    def _check_sketch_granularity(self, cohort):
+        if cohort != 'month':
+            raise ValueError("приближенный режим строит только месячные когорты (cohort='month')")
+    
+    def calculate_cohort_retention(self, cohort='month', period='day', max_period=None, last=None):
+        # Плотная матрица строится по длинной таблице только для last последних когорт и периодов до max_period
+        if self.approximate:
+            self._check_sketch_granularity(cohort)
+            return self.build_cohort_sketch().cohort_retention(period=period, max_period=max_period, last=last)
+        if self.uses_state:
+            return self._aggregate_state().cohort_retention(cohort, period, max_period, last)
         
-        return retention_matrix, cohort_pivot
+        return cohort_matrices(self.features.cohort_counts(cohort, period, max_period), last=last, max_period=max_period)
     
     def calculate_rolling_retention(self, days=[1, 7, 30]):
-        results = {}
+        if self.uses_state:
+            return self._aggregate_state(days).rolling_retention(days)
         
-        for day in days:
-            daily_retention = []
-            dates = []
-            all_dates = sorted(self.df['date'].unique())
-            
-            for current_date in all_dates:
-                users_today = set(self.df[self.df['date'] == current_date]['telegram_id'])
-                
-                if len(users_today) == 0:
-                    continue
-                
-                check_date = current_date + timedelta(days=day)
-                users_check_date = set(self.df[self.df['date'] == check_date]['telegram_id'])
-                retained_users = users_today.intersection(users_check_date)
-                
-                retention_rate = len(retained_users) / len(users_today) * 100 if len(users_today) > 0 else 0
-                
-                daily_retention.append(retention_rate)
-                dates.append(current_date)
-            
-            retention_df = pd.DataFrame({
-                'date': dates,
-                f'retention_day_{day}': daily_retention
-            })
-            
-            results[f'day_{day}'] = retention_df
-        
-        return results
+        return rolling_retention(self.df['telegram_id'].values, self.features.day_numbers, days)
+    
+    def build_activity_index(self):
+        if self.df is None:
+            raise ValueError('индекс активности строится по таблице событий и недоступен при memory_budget')
+        return ActivityIndex(self.df['telegram_id'].values, self.features.day_numbers)
     
     def calculate_repeat_purchase_rate(self):
-        user_purchases = self.df.groupby('telegram_id').size().reset_index()
-        user_purchases.columns = ['telegram_id', 'purchase_count']
-        
-        user_purchases['category'] = pd.cut(
-            user_purchases['purchase_count'], 
-            bins=[0, 1, 2, 5, 10, float('inf')], 
-            labels=['1 покупка', '2 покупки', '3-5 покупок', '6-10 покупок', '10+ покупок']
-        )
-        
-        category_stats = user_purchases['category'].value_counts()
+        if self.uses_state:
+            return self._aggregate_state().repeat_purchases()
         
-        return user_purchases, category_stats
+        return categorize_purchases(self.features.purchase_count.reset_index())
+    
+    def calculate_segmented_retention(self, keys=('sub_name',), days=[1, 7, 30]):
+        # Retention, когорты и распределение покупок по всем сегментам за один проход
+        if self.df is None:
+            raise ValueError('сегменты считаются по таблице событий и недоступны при memory_budget')
+        return segmented_retention(self.features, keys, days)
+    
+    def calculate_renewals(self, grace_days=GRACE_DAYS, by=('cohort_month', 'sub_name')):
+        # Продления с учетом срока тарифа: вовремя, в grace-окне, отток - по когортам и тарифам
+        if self.df is None:
+            raise ValueError('продления считаются по таблице событий и недоступны при memory_budget')
+        renewals = renewal_events(self.features, grace_days=grace_days)
+        return renewal_rates(renewals, by=by), renewals
     
     def analyze_subscription_patterns(self):
-        sub_stats = self.df['sub_name'].value_counts()
-        
-        self.df['day_of_week'] = self.df['datetime'].dt.day_name()
-        dow_stats = self.df['day_of_week'].value_counts()
-        
-        self.df['hour'] = self.df['datetime'].dt.hour
-        hourly_stats = self.df['hour'].value_counts().sort_index()
+        if self.df is None:
+            return self._aggregate_state().subscription_patterns()
         
-        return sub_stats, dow_stats, hourly_stats
+        features = self.features
+        return features.sub_stats, features.dow_stats, features.hourly_stats
     
-    def create_visualizations(self, retention_data, cohort_matrix):
-        plt.style.use('seaborn-v0_8')
-        fig = plt.figure(figsize=(20, 15))
+    def create_visualizations(self, retention_data, cohort_matrix, preset=charts.DEFAULT_PRESET, layout='grid',
+                              n_jobs=-1, output_dir='.', period='day'):
+        # Данные для панелей готовятся здесь, отрисовка (Agg, пул процессов) - в charts.py
+        if self.df is None:
+            state = self._aggregate_state()
+            dow_counts = state.event_counts['day_of_week']
+            hourly_counts = state.event_counts['hour'].sort_index()
+            pivot_hour_dow = state.hour_by_day_of_week()
+            daily_purchases = state.daily_purchases()
+        else:
+            dow_counts = self.features.dow_stats
+            hourly_counts = self.features.hourly_stats
+            pivot_hour_dow = self.features.hour_by_day_of_week
+            daily_purchases = self.features.daily_purchases
+        dow_counts = dow_counts.reindex(charts.DOW_ORDER)
+        # Гранулярность когорт - из имени индекса матрицы (cohort_month, cohort_week, ...)
+        cohort = str(cohort_matrix.index.name).replace('cohort_', '')
+        cohort_label = GRANULARITY_PLURAL.get(cohort, 'когорт')
         
-        ax1 = plt.subplot(2, 3, 1)
-        for day_key, data in retention_data.items():
-            day_num = day_key.split('_')[1]
-            plt.plot(data['date'], data[f'retention_day_{day_num}'], 
-                    label=f'Day {day_num}', marker='o', markersize=3)
-        plt.title('Динамика Retention по дням', fontsize=14, fontweight='bold')
-        plt.xlabel('Дата')
-        plt.ylabel('Retention (%)')
-        plt.legend()
-        plt.xticks(rotation=45)
-        plt.grid(True, alpha=0.3)
-        
-        ax2 = plt.subplot(2, 3, 2)
-        sns.heatmap(cohort_matrix.iloc[-6:], annot=True, fmt='.1f', cmap='YlOrRd', 
-                   cbar_kws={'label': 'Retention (%)'})
-        plt.title('Когортный Retention (последние 6 месяцев)', fontsize=14, fontweight='bold')
-        plt.xlabel('Дни с первой покупки')
-        plt.ylabel('Когорта (месяц)')
-        
-        ax3 = plt.subplot(2, 3, 3)
-        dow_counts = self.df['day_of_week'].value_counts()
-        dow_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        dow_counts = dow_counts.reindex(dow_order)
-        plt.bar(range(len(dow_counts)), dow_counts.values)
-        plt.title('Покупки по дням недели', fontsize=14, fontweight='bold')
-        plt.xlabel('День недели')
-        plt.ylabel('Количество покупок')
-        plt.xticks(range(len(dow_counts)), [d[:3] for d in dow_counts.index], rotation=45)
-        
-        ax4 = plt.subplot(2, 3, 4)
-        hourly_counts = self.df['hour'].value_counts().sort_index()
-        plt.plot(hourly_counts.index, hourly_counts.values, marker='o')
-        plt.title('Покупки по часам дня', fontsize=14, fontweight='bold')
-        plt.xlabel('Час')
-        plt.ylabel('Количество покупок')
-        plt.grid(True, alpha=0.3)
-        
-        ax5 = plt.subplot(2, 3, 5)
-        pivot_hour_dow = self.df.pivot_table(values='id', index='day_of_week', columns='hour', 
-                                           aggfunc='count', fill_value=0)
-        dow_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        pivot_hour_dow = pivot_hour_dow.reindex(dow_order)
-        sns.heatmap(pivot_hour_dow, cmap='YlOrRd', cbar_kws={'label': 'Количество покупок'})
-        plt.title('Активность по дням недели и часам', fontsize=14, fontweight='bold')
-        plt.xlabel('Час')
-        plt.ylabel('День недели')
-        
-        ax6 = plt.subplot(2, 3, 6)
-        daily_purchases = self.df.groupby('date').size()
-        plt.plot(daily_purchases.index, daily_purchases.values, marker='o', markersize=2)
-        plt.title('Динамика ежедневных покупок', fontsize=14, fontweight='bold')
-        plt.xlabel('Дата')
-        plt.ylabel('Количество покупок')
-        plt.xticks(rotation=45)
-        plt.grid(True, alpha=0.3)
-        
-        plt.tight_layout()
-        plt.savefig('retention_analysis.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        panels = [
+            (charts.retention_lines, {'retention_data': retention_data}),
+            (charts.cohort_heatmap, {'matrix': cohort_matrix.iloc[-6:],
+                                     'title': f'Когортный Retention (последние 6 {cohort_label})',
+                                     'ylabel': f'Когорта ({GRANULARITY_SINGULAR.get(cohort, cohort)})',
+                                     'xlabel': f'{PERIOD_AXIS[period]} с первой покупки'}),
+            (charts.weekday_bars, {'counts': dow_counts.values, 'labels': [d[:3] for d in dow_counts.index],
+                                   'rotation': 45}),
+            (charts.hourly_line, {'counts': hourly_counts}),
+            (charts.hour_weekday_heatmap, {'pivot': pivot_hour_dow.reindex(charts.DOW_ORDER)}),
+            (charts.daily_line, {'daily': daily_purchases}),
+        ]
+        figure = charts.figure('retention_analysis', panels, nrows=2, ncols=3, figsize=(20, 15),
+                               style='seaborn-v0_8')
+        return charts.render([figure], preset=preset, layout=layout, n_jobs=n_jobs, output_dir=output_dir)
     
     def generate_recommendations(self, retention_data, user_purchases):
         avg_retention_1d = np.mean([data[f'retention_day_1'].mean() for data in retention_data.values() if f'retention_day_1' in data.columns])
@@ -182,13 +246,18 @@ class RetentionAnalyzer:
             'repeat_rate': repeat_rate
         }
     
-    def run_full_analysis(self):
-        cohort_matrix, cohort_pivot = self.calculate_cohort_retention()
-        retention_data = self.calculate_rolling_retention()
-        user_purchases, category_stats = self.calculate_repeat_purchase_rate()
-        sub_stats, dow_stats, hourly_stats = self.analyze_subscription_patterns()
-        self.create_visualizations(retention_data, cohort_matrix)
-        recommendations = self.generate_recommendations(retention_data, user_purchases)
+    def run_full_analysis(self, visualize=True, preset=charts.DEFAULT_PRESET, layout='grid',
+                          cohort='month', period='day', max_period=None):
+        cohort_matrix, cohort_pivot = self._run_stage('calculate_cohort_retention', self.calculate_cohort_retention,
+                                                      cohort, period, max_period)
+        retention_data = self._run_stage('calculate_rolling_retention', self.calculate_rolling_retention)
+        user_purchases, category_stats = self._run_stage('calculate_repeat_purchase_rate', self.calculate_repeat_purchase_rate)
+        sub_stats, dow_stats, hourly_stats = self._run_stage('analyze_subscription_patterns', self.analyze_subscription_patterns)
+        if visualize:
+            self._run_stage('create_visualizations',
+                            lambda *args: self.create_visualizations(*args, period=period),
+                            retention_data, cohort_matrix, preset, layout)
+        recommendations = self._run_stage('generate_recommendations', self.generate_recommendations, retention_data, user_purchases)
         
         return {
             'cohort_matrix': cohort_matrix,
@@ -200,9 +269,50 @@ class RetentionAnalyzer:
             'recommendations': recommendations
         }
 
-def main():
-    analyzer = RetentionAnalyzer('user_logs_paid_241024_250909.json')
-    results = analyzer.run_full_analysis()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Анализ ретеншна пользователей')
+    parser.add_argument('data_file', nargs='*', default=['user_logs_paid_241024_250909.json'],
+                        help='файлы выгрузок, glob-шаблоны или каталоги')
+    parser.add_argument('--load-jobs', type=int, default=-1,
+                        help='процессов для разбора нескольких файлов (-1 - по числу ядер)')
+    parser.add_argument('--profile', metavar='TRACE_JSON', default=None,
+                        help='замерить стадии и сохранить JSON-трассу')
+    parser.add_argument('--no-charts', action='store_true', help='только метрики, без графиков')
+    parser.add_argument('--preset', default=charts.DEFAULT_PRESET, choices=sorted(charts.PRESETS),
+                        help='разрешение и формат графиков')
+    parser.add_argument('--layout', default='grid', choices=charts.LAYOUTS,
+                        help="'panels' - каждая панель отдельным файлом, панели рисуются параллельно")
+    parser.add_argument('--cohort', default='month', choices=GRANULARITIES, help='гранулярность когорт')
+    parser.add_argument('--period', default='day', choices=GRANULARITIES,
+                        help='гранулярность периодов с первой покупки')
+    parser.add_argument('--max-period', type=int, default=None, help='горизонт когортной матрицы в периодах')
+    parser.add_argument('--segments', nargs='+', metavar='KEY', default=None,
+                        help="сегментный retention по ключам первой покупки: sub_name, cohort_month, cohort_week, first_weekday")
+    parser.add_argument('--approximate', action='store_true',
+                        help='когорты по HyperLogLog-скетчам (приближенно, фиксированная память на ячейку)')
+    parser.add_argument('--sketch-precision', type=int, default=DEFAULT_PRECISION,
+                        help='2^p регистров на ячейку, стандартная ошибка 1.04/sqrt(2^p)')
+    parser.add_argument('--renewals', action='store_true',
+                        help='продления по сроку тарифа: вовремя, в grace-окне, отток по когортам и тарифам')
+    parser.add_argument('--grace-days', type=float, default=GRACE_DAYS)
+    args = parser.parse_args(argv)
+    
+    profiler = StageProfiler() if args.profile else None
+    analyzer = RetentionAnalyzer(args.data_file, profiler=profiler, load_jobs=args.load_jobs,
+                                 approximate=args.approximate,
+                                 sketch_precision=args.sketch_precision)
+    results = analyzer.run_full_analysis(visualize=not args.no_charts, preset=args.preset, layout=args.layout,
+                                         cohort=args.cohort, period=args.period, max_period=args.max_period)
+    if args.segments:
+        results['segments'] = analyzer._run_stage('calculate_segmented_retention', analyzer.calculate_segmented_retention,
+                                                  args.segments)
+        print(results['segments'].round(2).to_string())
+    if args.renewals:
+        results['renewals'], _ = analyzer._run_stage('calculate_renewals', analyzer.calculate_renewals, args.grace_days)
+        print(results['renewals'].round(1).to_string())
+    if profiler is not None:
+        profiler.save(args.profile)
+        print(profiler.summary())
     return results
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+PURCHASE_BINS = [0, 1, 2, 5, 10, float('inf')]
+PURCHASE_LABELS = ['1 покупка', '2 покупки', '3-5 покупок', '6-10 покупок', '10+ покупок']
+
+# Гранулярность когорт и периодов: день, неделя (с понедельника) или календарный месяц
+GRANULARITIES = ('day', 'week', 'month')
+PERIOD_FREQ = {'day': 'D', 'week': 'W', 'month': 'M'}
+GRANULARITY_PLURAL = {'day': 'дней', 'week': 'недель', 'month': 'месяцев'}
+GRANULARITY_SINGULAR = {'day': 'день', 'week': 'неделя', 'month': 'месяц'}
+PERIOD_AXIS = {'day': 'Дни', 'week': 'Недели', 'month': 'Месяцы'}
+
+
+def to_day_numbers(dates):
+    # Календарные даты -> номер дня от 1970-01-01 (int64)
+    return pd.to_datetime(pd.Series(dates)).values.astype('datetime64[D]').astype(np.int64)
+
+
+def from_day_numbers(day_numbers):
+    # Обратное преобразование в даты того же типа, что и колонка df['date']
+    return pd.to_datetime(np.asarray(day_numbers, dtype=np.int64).astype('datetime64[D]'))
+
+
+def unique_sorted(values):
+    # Сортировкой, а не np.unique: в NumPy 2.x он по умолчанию хэширует и на int64 заметно медленнее
+    values = np.sort(np.asarray(values), kind='stable')
+    if len(values) == 0:
+        return values
+    return values[np.r_[True, values[1:] != values[:-1]]]
+
+
+def unique_inverse(values):
+    # Уникальные значения (отсортированные), обратный индекс и количества
+    values = np.asarray(values)
+    order = np.argsort(values, kind='stable')
+    ordered = values[order]
+    flags = np.r_[True, ordered[1:] != ordered[:-1]] if len(values) else np.zeros(0, dtype=bool)
+    inverse = np.empty(len(values), dtype=np.int64)
+    inverse[order] = np.cumsum(flags) - 1
+    starts = np.flatnonzero(flags)
+    counts = np.diff(np.r_[starts, len(values)])
+    return ordered[starts], inverse, counts
+
+
+def user_day_keys(user_ids, day_numbers):
+    # Уникальные пары (пользователь, день), упакованные в один отсортированный int64-ключ:
+    # key = (day - first_day) * n_users + user_code, то есть сортировка идет по дню, затем по пользователю
+    user_ids = np.asarray(user_ids)
+    day_numbers = np.asarray(day_numbers, dtype=np.int64)
+    _, user_codes, _ = unique_inverse(user_ids)
+    n_users = int(user_codes.max()) + 1 if len(user_codes) else 1
+    first_day = int(day_numbers.min()) if len(day_numbers) else 0
+    keys = unique_sorted((day_numbers - first_day) * n_users + user_codes)
+    return keys, n_users, first_day
+
+
+def retention_counts(user_ids, day_numbers, days):
+    # Для каждого дня d: число активных пользователей и число тех из них,
+    # кто был активен в день d + N, для всех N из days за один проход по парам
+    keys, n_users, first_day = user_day_keys(user_ids, day_numbers)
+    pair_days = keys // n_users
+    active = np.bincount(pair_days) if len(keys) else np.zeros(0, dtype=np.int64)
+
+    retained = {}
+    for day in days:
+        targets = keys + int(day) * n_users
+        pos = np.searchsorted(keys, targets)
+        hit = pos < len(keys)
+        hit[hit] = keys[pos[hit]] == targets[hit]
+        retained[day] = np.bincount(pair_days[hit], minlength=len(active))
+
+    active_days = np.nonzero(active)[0]
+    return (
+        active_days + first_day,
+        active[active_days],
+        {day: counts[active_days] for day, counts in retained.items()},
+    )
+
+
+def rolling_retention(user_ids, day_numbers, days=(1, 7, 30)):
+    # Тот же результат, что и построчный перебор дат в calculate_rolling_retention
+    active_day_numbers, active, retained = retention_counts(user_ids, day_numbers, days)
+    return rolling_frames(active_day_numbers, active, retained, days)
+
+
+def rolling_frames(active_day_numbers, active, retained, days):
+    dates = from_day_numbers(active_day_numbers)
+    active = np.asarray(active).astype(np.float64)
+
+    results = {}
+    for day in days:
+        results[f'day_{day}'] = pd.DataFrame({
+            'date': dates,
+            f'retention_day_{day}': np.asarray(retained[day]) / active * 100
+        })
+
+    return results
+
+
+def _check_granularity(granularity):
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'неизвестная гранулярность {granularity!r}, ожидается одна из {GRANULARITIES}')
+
+
+def bucket_numbers(day_numbers, granularity):
+    # Номер дня от 1970-01-01 -> номер дня, недели (с понедельника) или месяца от 1970-01
+    _check_granularity(granularity)
+    day_numbers = np.asarray(day_numbers, dtype=np.int64)
+    if granularity == 'week':
+        # 1970-01-01 - четверг, первый понедельник - день 4
+        return (day_numbers + 3) // 7
+    if granularity == 'month':
+        return day_numbers.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    return day_numbers
+
+
+def bucket_labels(numbers, granularity):
+    # Номера из bucket_numbers -> pd.Period нужной частоты
+    _check_granularity(granularity)
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if granularity == 'week':
+        first_days = numbers * 7 - 3
+    elif granularity == 'month':
+        first_days = numbers.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    else:
+        first_days = numbers
+    return from_day_numbers(first_days).to_period(PERIOD_FREQ[granularity])
+
+
+def period_numbers(day_numbers, first_day_numbers, granularity):
+    # Номер периода с первой покупки: дни и недели - по смещению в днях (неделя N - дни 7N..7N+6),
+    # месяцы - по разнице календарных месяцев
+    _check_granularity(granularity)
+    if granularity == 'week':
+        return (np.asarray(day_numbers) - np.asarray(first_day_numbers)) // 7
+    return bucket_numbers(day_numbers, granularity) - bucket_numbers(first_day_numbers, granularity)
+
+
+def cohort_counts(pair_users, pair_days, first_day, cohort='month', period='day', max_period=None):
+    # Длинная таблица уникальных пользователей по (когорта, период) из уникальных пар
+    # пользователь-день: pair_users - номера пользователей в first_day. Хранятся только
+    # наблюдаемые ячейки, плотная матрица строится в cohort_matrices
+    pair_users = np.asarray(pair_users, dtype=np.int64)
+    first_day = np.asarray(first_day, dtype=np.int64)
+    periods = period_numbers(pair_days, first_day[pair_users], period)
+    if max_period is not None:
+        keep = periods <= max_period
+        pair_users, periods = pair_users[keep], periods[keep]
+    if period != 'day' and len(periods):
+        # Несколько дней одного периода - один пользователь в ячейке
+        n_users = len(first_day)
+        keys = unique_sorted(periods * n_users + pair_users)
+        periods, pair_users = keys // n_users, keys % n_users
+
+    cohorts = bucket_numbers(first_day, cohort)[pair_users]
+    base = int(cohorts.min()) if len(cohorts) else 0
+    span = int(periods.max()) + 1 if len(periods) else 1
+    cells, _, users = unique_inverse((cohorts - base) * span + periods)
+    return pd.DataFrame({
+        f'cohort_{cohort}': bucket_labels(cells // span + base, cohort),
+        'period': cells % span,
+        'users': users,
+    })
+
+
+def cohort_matrices(cohort_data, last=None, max_period=None):
+    # Длинная таблица (когорта, period, users) -> матрица ретеншна и абсолютные значения.
+    # Плотная матрица строится только для нужного среза: last последних когорт, периоды до max_period
+    cohort = cohort_data.columns[0]
+    if max_period is not None:
+        cohort_data = cohort_data[cohort_data['period'] <= max_period]
+    if last is not None:
+        cohorts = cohort_data[cohort].drop_duplicates().sort_values()
+        if len(cohorts) > last:
+            cohort_data = cohort_data[cohort_data[cohort] >= cohorts.iloc[-last]]
+    cohort_pivot = cohort_data.pivot(index=cohort, columns='period', values='users')
+    if max_period is not None and len(cohort_data):
+        # Горизонт - сплошной диапазон периодов, а не только наблюдаемые
+        cohort_pivot = cohort_pivot.reindex(columns=range(min(max_period, int(cohort_data['period'].max())) + 1))
+    cohort_pivot = cohort_pivot.fillna(0)
+    
+    # Период 0 - первая покупка, он есть у каждой когорты (пустая выборка - пустые матрицы)
+    cohort_sizes = cohort_pivot.iloc[:, 0] if len(cohort_pivot.columns) else pd.Series(dtype=np.float64)
+    retention_matrix = cohort_pivot.div(cohort_sizes, axis=0) * 100
+    
+    return retention_matrix, cohort_pivot
+
+
+def categorize_purchases(user_purchases):
+    # То же, что pd.cut(bins=PURCHASE_BINS, labels=PURCHASE_LABELS), но коды (число левых границ
+    # меньше значения) копятся сразу в int8, без промежуточных float- и int64-массивов на пользователя
+    counts = user_purchases['purchase_count'].values
+    codes = np.full(len(counts), -1, dtype=np.int8)
+    for bound in PURCHASE_BINS[:-1]:
+        codes += counts > bound
+    user_purchases['category'] = pd.Categorical.from_codes(codes, categories=PURCHASE_LABELS, ordered=True)
+    
+    category_stats = user_purchases['category'].value_counts()
+    
+    return user_purchases, category_stats
@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from event_sources import expand_sources
+from retention_analysis import RetentionAnalyzer
+from retention_engine import GRANULARITIES
+
+# Долгоживущий сервис запросов: выгрузки загружаются и индексируются один раз (RetentionAnalyzer,
+# производные признаки кэшируются в EventFeatures), а HTTP-запросы на localhost отвечают JSON.
+# Готовые ответы лежат в LRU-кэше по (путь, параметры), поэтому повторные запросы дашбордов
+# не пересчитываются. При изменении файлов-источников (размер, mtime, новые файлы в каталоге)
+# новый индекс строится в отдельном потоке, пока запросы отвечает прежний, затем индекс,
+# сигнатура и кэш подменяются разом.
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+CACHE_SIZE = 256
+RELOAD_INTERVAL = 2.0
+MAX_REQUEST_BYTES = 64 << 10
+# Горизонт Day-N retention в запросе: 10 лет (большие N переполняют сдвиг дат)
+MAX_DAYS = 3650
+
+# Параметры фильтра, общие для всех запросов: даты первого и последнего дня и значения колонок
+FILTER_COLUMNS = ('sub_name', 'action')
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def to_jsonable(value):
+    # Значения pandas/numpy -> типы json; NaN -> null
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray, pd.Index)):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, (pd.Timestamp, pd.Period)):
+        return str(value.date()) if isinstance(value, pd.Timestamp) else str(value)
+    return value
+
+
+def _series(series):
+    return {'labels': list(series.index), 'values': list(series.values)}
+
+
+def _matrix(frame):
+    return {
+        'cohorts': list(frame.index),
+        'periods': list(frame.columns),
+        'values': [list(row) for row in frame.values.round(4)],
+    }
+
+
+def _one(params, name, default=None):
+    values = params.get(name)
+    return values[-1] if values else default
+
+
+def _int(params, name, default=None):
+    value = _one(params, name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f'параметр {name} должен быть целым числом') from None
+
+
+def _list(params, name):
+    # ?days=1,7,30 и ?days=1&days=7 - одно и то же
+    return [item for value in params.get(name, []) for item in value.split(',') if item]
+
+
+def _choice(params, name, default):
+    value = _one(params, name, default)
+    if value not in GRANULARITIES:
+        raise QueryError(f'параметр {name} - один из {GRANULARITIES}')
+    return value
+
+
+def cache_key(path, params):
+    return path, tuple(sorted((name, tuple(values)) for name, values in params.items()))
+
+
+class RetentionService:
+    def __init__(self, data_file, cache_size=CACHE_SIZE, **analyzer_options):
+        self.data_file = data_file
+        self.cache_size = cache_size
+        # Индекс строится и считается в потоках сервиса, а fork пула процессов из потока может
+        # унаследовать чужие захваченные замки и зависнуть - файлы разбираются и метрики
+        # считаются в этом процессе
+        self.analyzer_options = dict(analyzer_options, load_jobs=1, n_jobs=1)
+        # Под замком только подмена и чтение ссылок на индекс и кэш, не расчеты
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.signature = None
+        self.failed_signature = None
+        self.analyzer = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.routes = {
+            '/status': self.status,
+            '/cohorts': self.cohorts,
+            '/retention': self.retention,
+            '/repeat': self.repeat_purchases,
+            '/stats': self.stats,
+        }
+        self.load()
+
+    # Индекс и перезагрузка
+
+    def source_signature(self):
+        # Список файлов заново: в каталог или под шаблон могли добавить выгрузки
+        paths = expand_sources(self.data_file)
+        return tuple((os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths)
+
+    def load(self):
+        signature = self.source_signature()
+        analyzer = RetentionAnalyzer(self.data_file, **self.analyzer_options)
+        # Запрос, начатый до подмены, досчитывается по старому индексу и кладет ответ
+        # в старый кэш, поэтому в новый кэш не попадает ничего устаревшего
+        with self.lock:
+            self.analyzer, self.signature = analyzer, signature
+            self.loaded_at = time.time()
+            self.cache = OrderedDict()
+        return analyzer
+
+    def reload_if_changed(self):
+        # Пока файл переписывается (не читается или не разбирается), отвечает прежний индекс,
+        # а проверка повторяется, когда файлы снова изменятся
+        signature = None
+        try:
+            signature = self.source_signature()
+            if signature in (self.signature, self.failed_signature):
+                return False
+            self.load()
+        except Exception as error:
+            self.failed_signature = signature
+            print(f'перезагрузка не удалась, отвечает прежний индекс: {type(error).__name__}: {error}')
+            return False
+        self.reloads += 1
+        return True
+
+    # Запросы
+
+    def query(self, path, params):
+        # Готовое тело ответа из кэша или расчет; ошибки параметров - QueryError
+        handler = self.routes.get(path)
+        if handler is None:
+            raise KeyError(path)
+        key = cache_key(path, params)
+        with self.lock:
+            analyzer, cache = self.analyzer, self.cache
+        if key in cache:
+            cache.move_to_end(key)
+            self.hits += 1
+            return cache[key]
+
+        self.misses += 1
+        body = json.dumps(to_jsonable(handler(analyzer, params)), ensure_ascii=False).encode('utf-8')
+        if path != '/status':
+            cache[key] = body
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return body
+
+    def select(self, analyzer, params):
+        # ?from=2025-01-01&to=2025-03-31&sub_name=30 дней - анализатор над частью событий
+        columns = {name: _list(params, name) for name in FILTER_COLUMNS if _list(params, name)}
+        start, end = _one(params, 'from'), _one(params, 'to')
+        if start is None and end is None and not columns:
+            return analyzer
+        try:
+            return analyzer.subset(start=start, end=end, **columns)
+        except (TypeError, ValueError) as error:
+            raise QueryError(str(error)) from None
+
+    def status(self, analyzer, params):
+        with self.lock:
+            signature, loaded_at, cache = self.signature, self.loaded_at, self.cache
+        return {
+            'sources': [path for path, _, _ in signature],
+            'events': len(analyzer.df) if analyzer.df is not None else None,
+            'loaded_at': datetime.fromtimestamp(loaded_at).isoformat(timespec='seconds'),
+            'reloads': self.reloads,
+            'cache': {'entries': len(cache), 'size': self.cache_size, 'hits': self.hits, 'misses': self.misses},
+        }
+
+    def cohorts(self, analyzer, params):
+        # ?cohort=week&period=day&max_period=30&last=6
+        analyzer = self.select(analyzer, params)
+        retention_matrix, cohort_pivot = analyzer.calculate_cohort_retention(
+            _choice(params, 'cohort', 'month'), _choice(params, 'period', 'day'),
+            _int(params, 'max_period'), _int(params, 'last'))
+        return {'retention': _matrix(retention_matrix), 'users': _matrix(cohort_pivot)}
+
+    def retention(self, analyzer, params):
+        # ?days=1,7,30 - средний rolling retention и ряд по датам для каждого N
+        try:
+            days = [int(day) for day in _list(params, 'days')] or [1, 7, 30]
+        except ValueError:
+            raise QueryError('параметр days - список целых чисел') from None
+        if any(day < 1 or day > MAX_DAYS for day in days):
+            raise QueryError(f'параметр days - числа от 1 до {MAX_DAYS}')
+        retention_data = self.select(analyzer, params).calculate_rolling_retention(days)
+        result = {}
+        for day in days:
+            data = retention_data[f'day_{day}']
+            values = data[f'retention_day_{day}']
+            result[f'day_{day}'] = {
+                'average': values.mean() if len(values) else None,
+                'dates': list(pd.to_datetime(data['date'])),
+                'values': list(values.values.round(4)),
+            }
+        return result
+
+    def repeat_purchases(self, analyzer, params):
+        user_purchases, category_stats = self.select(analyzer, params).calculate_repeat_purchase_rate()
+        users = len(user_purchases)
+        return {
+            'users': users,
+            'repeat_rate': (user_purchases['purchase_count'] > 1).sum() / users * 100 if users else None,
+            'categories': _series(category_stats),
+        }
+
+    def stats(self, analyzer, params):
+        sub_stats, dow_stats, hourly_stats = self.select(analyzer, params).analyze_subscription_patterns()
+        return {
+            'sub_name': _series(sub_stats),
+            'day_of_week': _series(dow_stats),
+            'hour': _series(hourly_stats),
+        }
+
+
+# HTTP поверх asyncio.start_server: только GET, один запрос на соединение
+
+def response(status, body):
+    head = (f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+            'Content-Type: application/json; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n')
+    return head.encode('ascii') + body
+
+
+def error_body(message):
+    return json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+
+
+class RetentionServer:
+    def __init__(self, service, host=DEFAULT_HOST, port=DEFAULT_PORT, reload_interval=RELOAD_INTERVAL):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.reload_interval = reload_interval
+        # Один поток на расчеты: признаки EventFeatures считаются без гонок, а цикл событий
+        # продолжает принимать соединения. Новый индекс строится в своем потоке и запросы не ждут
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.reload_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self.dispatch(reader)
+        except Exception as error:
+            status, body = 500, error_body(f'{type(error).__name__}: {error}')
+        try:
+            writer.write(response(status, body))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def dispatch(self, reader):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return 400, error_body('некорректный HTTP-запрос')
+        # Браузеры кодируют query процентами, curl и скрипты могут прислать сырой UTF-8
+        try:
+            parts = head.split(b'\r\n', 1)[0].decode('utf-8').split()
+        except UnicodeDecodeError:
+            return 400, error_body('строка запроса не в UTF-8')
+        if len(parts) != 3:
+            return 400, error_body('некорректная строка запроса')
+        method, target, _ = parts
+        if method != 'GET':
+            return 405, error_body('поддерживается только GET')
+
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.executor, self.service.query, url.path.rstrip('/') or '/', params)
+        except KeyError:
+            return 404, error_body(f'неизвестный путь {url.path}, доступны {sorted(self.service.routes)}')
+        except QueryError as error:
+            return 400, error_body(str(error))
+        return 200, body
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            if await loop.run_in_executor(self.reload_executor, self.service.reload_if_changed):
+                print(f'источники изменились, индекс перестроен ({len(self.service.analyzer.df)} событий)')
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=MAX_REQUEST_BYTES)
+        watcher = asyncio.create_task(self.watch()) if self.reload_interval else None
+        print(f'Сервис retention: http://{self.host}:{self.port} ({", ".join(sorted(self.service.routes))})')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self.executor.shutdown(wait=False)
+            self.reload_executor.shutdown(wait=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сервис запросов retention на localhost')
+    parser.add_argument('data_file', nargs='*', default=['user_logs_paid_241024_250909.json'],
+                        help='файлы выгрузок, glob-шаблоны или каталоги')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help='ответов в LRU-кэше')
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help='секунд между проверками файлов-источников (0 - без перезагрузки)')
+    args = parser.parse_args(argv)
+
+    service = RetentionService(args.data_file, cache_size=args.cache_size)
+    server = RetentionServer(service, host=args.host, port=args.port, reload_interval=args.reload_interval)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,574 @@
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from event_cache import content_hash
+from event_loader import CHUNK_SIZE, DATETIME_FORMAT, READ_BLOCK_SIZE, add_dates, iter_event_chunks, load_events
+from event_sources import add_seen, drop_seen
+from retention_engine import (categorize_purchases, cohort_counts, cohort_matrices, retention_counts,
+                              rolling_frames, to_day_numbers, unique_inverse, unique_sorted)
+
+# Накопленное состояние для инкрементального пересчета: новые выгрузки "докладываются"
+# в него, а результаты совпадают с полным пересчетом по всей истории.
+STATE_VERSION = 3
+DEFAULT_DAYS = (1, 7, 30)
+
+# Аддитивные счетчики по событиям: подписки, дни недели, часы, их сочетание и покупки по датам
+EVENT_COUNTERS = ('sub_name', 'day_of_week', 'hour', 'hour_by_day_of_week', 'date')
+
+# Оценки для режима с ограниченной памятью (пики tracemalloc на синтетических выгрузках с запасом):
+# сырая запись в чанке (dict, строки, списки колонок, кадр и счетчики), рабочий объем на событие
+# в RetentionState.update_arrays (пары, сортировки, группировки когорт и дней), итоговые массивы
+# на пользователя вместе со сборкой и отсортированные id прочитанных выгрузок вместе со слиянием
+# (add_seen). JSON_RECORD_BYTES - нижняя граница размера записи в файле: по ней число событий
+# оценивается сверху. Под эти оценки отводится BUDGET_SHARE бюджета, остальное - запас на
+# фрагментацию аллокатора, чтобы пик RSS сверх библиотек оставался в бюджете
+RAW_RECORD_BYTES = 1200
+PARTITION_EVENT_BYTES = 256
+USER_RESULT_BYTES = 32
+SEEN_ID_BYTES = 32
+JSON_RECORD_BYTES = 100
+MIN_CHUNK_RECORDS = 1000
+BUDGET_SHARE = 0.75
+
+# Пара (пользователь, день) упакована в int64: telegram_id << 16 | номер дня от 1970-01-01
+DAY_BITS = 16
+DAY_MASK = (1 << DAY_BITS) - 1
+MAX_USER_ID = 1 << (63 - DAY_BITS)
+
+
+def pack_pairs(user_ids, day_numbers, unique=True):
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    day_numbers = np.asarray(day_numbers, dtype=np.int64)
+    if len(day_numbers) and (day_numbers.min() < 0 or day_numbers.max() > DAY_MASK):
+        raise ValueError('даты событий вне диапазона 1970-01-01 .. 2149-06-06')
+    if len(user_ids) and (user_ids.min() < 0 or user_ids.max() >= MAX_USER_ID):
+        raise ValueError(f'telegram_id должен быть в диапазоне [0, {MAX_USER_ID})')
+    keys = (user_ids << DAY_BITS) | day_numbers
+    return unique_sorted(keys) if unique else keys
+
+
+def unpack_pairs(keys):
+    return keys >> DAY_BITS, keys & DAY_MASK
+
+
+def cohort_contribution(pair_users, pair_days, user_ids, first_day):
+    # Вклад пар в ячейки (месяц когорты, дней с первой покупки): каждая пара - один
+    # уникальный пользователь в ячейке, поэтому nunique сводится к подсчету пар
+    first = first_day[np.searchsorted(user_ids, pair_users)]
+    months = first.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    ones = pd.Series(np.ones(len(first), dtype=np.int64))
+    return ones.groupby([months, pair_days - first]).sum()
+
+
+def daily_contribution(pair_users, pair_days, days):
+    # Знаменатели (активные за день) и числители (вернувшиеся через N дней) rolling retention
+    active_days, active, retained = retention_counts(pair_users, pair_days, days)
+    columns = {'active': active}
+    for day in days:
+        columns[f'day_{day}'] = retained[day]
+    return pd.DataFrame(columns, index=active_days, dtype=np.int64)
+
+
+def combine(total, part, sign=1):
+    if len(part) == 0:
+        return total
+    if len(total) == 0:
+        total = part * sign
+    else:
+        total = total.add(part * sign, fill_value=0)
+    total = total.astype(np.int64).sort_index()
+    if isinstance(total, pd.DataFrame):
+        return total[total['active'] != 0]
+    return total[total != 0]
+
+
+def event_counters(events):
+    day_of_week = events['datetime'].dt.day_name()
+    hour = events['datetime'].dt.hour
+    ones = pd.Series(np.ones(len(events), dtype=np.int64), index=events.index)
+    return {
+        'sub_name': events['sub_name'].astype(str).value_counts(sort=False),
+        'day_of_week': day_of_week.value_counts(sort=False),
+        'hour': hour.value_counts(sort=False),
+        'hour_by_day_of_week': ones.groupby([day_of_week.rename('day_of_week'), hour.rename('hour')]).sum(),
+        'date': events.groupby('date').size(),
+    }
+
+
+def add_counters(total, part):
+    for name in EVENT_COUNTERS:
+        if len(part[name]) == 0:
+            continue
+        if len(total[name]) == 0:
+            total[name] = part[name].astype(np.int64)
+        else:
+            total[name] = total[name].add(part[name], fill_value=0).astype(np.int64)
+    return total
+
+
+def empty_counters():
+    return {name: pd.Series(dtype=np.int64) for name in EVENT_COUNTERS}
+
+
+def _dump_counter(series):
+    keys = series.index.tolist()
+    if isinstance(series.index, pd.DatetimeIndex):
+        keys = [key.strftime('%Y-%m-%d') for key in keys]
+    return {'names': list(series.index.names), 'keys': keys, 'counts': series.values.tolist()}
+
+
+def _load_counter(name, data):
+    if not data['keys']:
+        return pd.Series(dtype=np.int64)
+    if name == 'date':
+        index = pd.DatetimeIndex(pd.to_datetime(data['keys']), name=data['names'][0])
+    elif len(data['names']) > 1:
+        index = pd.MultiIndex.from_tuples([tuple(key) for key in data['keys']], names=data['names'])
+    else:
+        index = pd.Index(data['keys'], name=data['names'][0])
+    return pd.Series(data['counts'], index=index, dtype=np.int64)
+
+
+def _by_count(series, name):
+    # Порядок как у value_counts: по убыванию количества
+    series = series.sort_values(ascending=False, kind='stable')
+    series.index.name = name
+    return series.rename('count')
+
+
+def _read_only(values):
+    view = values.view()
+    view.flags.writeable = False
+    return view
+
+
+def _pairs_of(pair_keys, user_ids):
+    # Все пары заданных пользователей: пары отсортированы по пользователю, так что это
+    # непрерывные диапазоны, которые находятся бинарным поиском
+    lo = np.searchsorted(pair_keys, user_ids << DAY_BITS)
+    hi = np.searchsorted(pair_keys, (user_ids + 1) << DAY_BITS)
+    lengths = hi - lo
+    offsets = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+    return pair_keys[np.arange(lengths.sum()) + offsets]
+
+
+class RetentionState:
+    def __init__(self, days=DEFAULT_DAYS, tz=None):
+        self.days = tuple(int(day) for day in days)
+        self.tz = tz
+        self.user_ids = np.zeros(0, dtype=np.int64)
+        self.first_day = np.zeros(0, dtype=np.int64)
+        self.purchase_count = np.zeros(0, dtype=np.int64)
+        self.pair_keys = np.zeros(0, dtype=np.int64)
+        self.cohort_counts = pd.Series(dtype=np.int64)
+        self.daily = pd.DataFrame(columns=self._daily_columns(), dtype=np.int64)
+        self.event_counts = empty_counters()
+        self.sources = []
+        # id уже учтенных событий (отсортированы): выгрузки с пересекающимися окнами
+        # не удваивают покупки и счетчики
+        self.seen_ids = np.zeros(0, dtype=np.int64)
+
+    def _daily_columns(self):
+        return ['active'] + [f'day_{day}' for day in self.days]
+
+    @classmethod
+    def from_events(cls, events, days=DEFAULT_DAYS, tz=None):
+        state = cls(days, tz=tz)
+        state.update(events)
+        return state
+
+    def update(self, events):
+        events = drop_seen(events, self.seen_ids)
+        self.seen_ids = add_seen(self.seen_ids, events['id'].values)
+        add_counters(self.event_counts, event_counters(events))
+        return self.update_arrays(events['telegram_id'].values, to_day_numbers(events['date']))
+
+    def update_arrays(self, user_ids, day_numbers):
+        # Пересчитываются только пользователи из пачки: их старый вклад вычитается,
+        # новый (с учетом всей их истории) прибавляется. Так корректно обрабатываются
+        # опоздавшие события, сдвигающие дату первой покупки.
+        batch_users = np.asarray(user_ids, dtype=np.int64)
+        if not len(batch_users):
+            return self
+        batch_keys = pack_pairs(batch_users, day_numbers)
+        batch_ids, _, batch_counts = unique_inverse(batch_users)
+
+        pos = np.searchsorted(self.user_ids, batch_ids)
+        known = pos < len(self.user_ids)
+        known[known] = self.user_ids[pos[known]] == batch_ids[known]
+
+        old_keys = _pairs_of(self.pair_keys, batch_ids[known])
+        new_keys = unique_sorted(np.concatenate([old_keys, batch_keys]))
+        added_keys = np.setdiff1d(batch_keys, old_keys, assume_unique=True)
+
+        new_users, new_days = unpack_pairs(new_keys)
+        starts = np.flatnonzero(np.r_[True, new_users[1:] != new_users[:-1]])
+        new_first = new_days[starts]
+
+        old_users, old_days = unpack_pairs(old_keys)
+        old_first = self.first_day[pos[known]]
+        self.cohort_counts = combine(self.cohort_counts,
+                                     cohort_contribution(old_users, old_days, batch_ids[known], old_first), -1)
+        self.cohort_counts = combine(self.cohort_counts,
+                                     cohort_contribution(new_users, new_days, batch_ids, new_first))
+        self.daily = combine(self.daily, daily_contribution(old_users, old_days, self.days), -1)
+        self.daily = combine(self.daily, daily_contribution(new_users, new_days, self.days))
+
+        self.first_day[pos[known]] = new_first[known]
+        self.purchase_count[pos[known]] += batch_counts[known]
+        insert_at = pos[~known]
+        self.user_ids = np.insert(self.user_ids, insert_at, batch_ids[~known])
+        self.first_day = np.insert(self.first_day, insert_at, new_first[~known])
+        self.purchase_count = np.insert(self.purchase_count, insert_at, batch_counts[~known])
+        self.pair_keys = np.insert(self.pair_keys, np.searchsorted(self.pair_keys, added_keys), added_keys)
+        return self
+
+    @classmethod
+    def merge(cls, states):
+        # Слияние состояний по непересекающимся множествам пользователей (партиции по
+        # telegram_id): все счетчики просто складываются
+        states = list(states)
+        days = states[0].days
+        if any(state.days != days for state in states):
+            raise ValueError('нельзя объединить состояния с разными наборами дней retention')
+        merged = cls(days, tz=states[0].tz)
+        user_ids = np.concatenate([state.user_ids for state in states])
+        order = np.argsort(user_ids, kind='stable')
+        merged.user_ids = user_ids[order]
+        if len(merged.user_ids) and (merged.user_ids[1:] == merged.user_ids[:-1]).any():
+            raise ValueError('объединяемые состояния содержат одних и тех же пользователей')
+        merged.first_day = np.concatenate([state.first_day for state in states])[order]
+        merged.purchase_count = np.concatenate([state.purchase_count for state in states])[order]
+        merged.pair_keys = np.sort(np.concatenate([state.pair_keys for state in states]))
+        merged.seen_ids = np.sort(np.concatenate([state.seen_ids for state in states]))
+        for state in states:
+            merged.cohort_counts = combine(merged.cohort_counts, state.cohort_counts)
+            merged.daily = combine(merged.daily, state.daily)
+            add_counters(merged.event_counts, state.event_counts)
+            merged.sources.extend(state.sources)
+        return merged
+
+    def cohort_data(self, cohort='month', period='day', max_period=None):
+        # Месячные когорты по дням берутся из накопленных счетчиков, остальные гранулярности -
+        # из пар пользователь-день (в состоянии из build_state_chunked их нет)
+        if (cohort, period) != ('month', 'day'):
+            if len(self.user_ids) and not len(self.pair_keys):
+                raise ValueError("состояние без пар пользователь-день поддерживает только cohort='month', period='day'")
+            pair_users, pair_days = unpack_pairs(self.pair_keys)
+            return cohort_counts(np.searchsorted(self.user_ids, pair_users), pair_days, self.first_day,
+                                 cohort, period, max_period)
+        index = self.cohort_counts.index
+        months = np.asarray(index.get_level_values(0), dtype=np.int64) if len(index) else np.zeros(0, np.int64)
+        periods = np.asarray(index.get_level_values(1), dtype=np.int64) if len(index) else np.zeros(0, np.int64)
+        cohort_data = pd.DataFrame({
+            'cohort_month': pd.to_datetime(months.astype('datetime64[M]')).to_period('M'),
+            'period': periods,
+            'users': self.cohort_counts.values,
+        })
+        if max_period is not None:
+            cohort_data = cohort_data[cohort_data['period'] <= max_period]
+        return cohort_data
+
+    def cohort_retention(self, cohort='month', period='day', max_period=None, last=None):
+        return cohort_matrices(self.cohort_data(cohort, period, max_period), last=last, max_period=max_period)
+
+    def rolling_retention(self, days=None):
+        days = self.days if days is None else days
+        missing = sorted(set(days) - set(self.days))
+        if missing:
+            raise ValueError(f'состояние не содержит retention для дней {missing}, доступны {list(self.days)}')
+        retained = {day: self.daily[f'day_{day}'].values for day in days}
+        return rolling_frames(self.daily.index.values, self.daily['active'].values, retained, days)
+
+    def repeat_purchases(self):
+        # Колонки - неизменяемые представления массивов состояния, без копий (при memory_budget
+        # это самые большие массивы); запись в них поднимает ValueError, а не портит состояние
+        user_purchases = pd.DataFrame({
+            'telegram_id': _read_only(self.user_ids),
+            'purchase_count': _read_only(self.purchase_count),
+        }, copy=False)
+        return categorize_purchases(user_purchases)
+
+    def subscription_patterns(self):
+        # Те же sub_stats, dow_stats, hourly_stats, что и analyze_subscription_patterns
+        sub_stats = _by_count(self.event_counts['sub_name'], 'sub_name')
+        dow_stats = _by_count(self.event_counts['day_of_week'], 'day_of_week')
+        hourly_stats = self.event_counts['hour'].sort_index().rename('count')
+        hourly_stats.index.name = 'hour'
+        return sub_stats, dow_stats, hourly_stats
+
+    def hour_by_day_of_week(self):
+        counts = self.event_counts['hour_by_day_of_week']
+        if len(counts) == 0:
+            return pd.DataFrame(dtype=np.int64)
+        return counts.unstack('hour', fill_value=0)
+
+    def daily_purchases(self):
+        return self.event_counts['date'].sort_index()
+
+    def is_ingested(self, digest):
+        return any(source['content_hash'] == digest for source in self.sources)
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        index = self.cohort_counts.index
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f,
+                user_ids=self.user_ids,
+                first_day=self.first_day,
+                purchase_count=self.purchase_count,
+                pair_keys=self.pair_keys,
+                seen_ids=self.seen_ids,
+                cohort_months=np.asarray(index.get_level_values(0) if len(index) else [], dtype=np.int64),
+                cohort_periods=np.asarray(index.get_level_values(1) if len(index) else [], dtype=np.int64),
+                cohort_users=self.cohort_counts.values.astype(np.int64),
+                daily_days=self.daily.index.values.astype(np.int64),
+                daily=self.daily.values.astype(np.int64),
+                meta=np.array(json.dumps({
+                    'version': STATE_VERSION,
+                    'days': list(self.days),
+                    'tz': self.tz,
+                    'sources': self.sources,
+                    'event_counts': {name: _dump_counter(self.event_counts[name]) for name in EVENT_COUNTERS},
+                }, ensure_ascii=False)),
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['version'] != STATE_VERSION:
+                raise ValueError(f'{path}: неподдерживаемая версия состояния {meta["version"]}')
+            state = cls(meta['days'], tz=meta['tz'])
+            state.sources = meta['sources']
+            state.event_counts = {name: _load_counter(name, meta['event_counts'][name]) for name in EVENT_COUNTERS}
+            state.user_ids = data['user_ids']
+            state.first_day = data['first_day']
+            state.purchase_count = data['purchase_count']
+            state.pair_keys = data['pair_keys']
+            state.seen_ids = data['seen_ids']
+            index = pd.MultiIndex.from_arrays([data['cohort_months'], data['cohort_periods']])
+            state.cohort_counts = pd.Series(data['cohort_users'], index=index)
+            state.daily = pd.DataFrame(data['daily'], index=data['daily_days'],
+                                       columns=state._daily_columns())
+        return state
+
+
+def partition_of(user_ids, n_partitions):
+    # Хэш-партиция по telegram_id (мультипликативное перемешивание, чтобы соседние id
+    # не попадали в одну партицию)
+    mixed = np.asarray(user_ids, dtype=np.int64).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return ((mixed >> np.uint64(32)) % np.uint64(n_partitions)).astype(np.int64)
+
+
+def _build_partition(args):
+    user_ids, day_numbers, days = args
+    return RetentionState(days).update_arrays(user_ids, day_numbers)
+
+
+def pool_context():
+    # Как в charts и event_sources: fork не переимпортирует __main__, поэтому скрипты без
+    # main-guard (cohort_analysis.py) не выполняются в воркерах заново
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def build_state(events, days=DEFAULT_DAYS, n_jobs=1, tz=None):
+    # Все метрики RetentionAnalyzer считаются по пользователям, поэтому события делятся на
+    # партиции по telegram_id, партиции обрабатываются в пуле процессов и сливаются точно
+    user_ids = events['telegram_id'].values.astype(np.int64)
+    day_numbers = to_day_numbers(events['date'])
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    if n_jobs == 1 or len(user_ids) == 0:
+        return RetentionState(days, tz=tz).update_arrays(user_ids, day_numbers)
+
+    parts = partition_of(user_ids, n_jobs)
+    order = np.argsort(parts, kind='stable')
+    bounds = np.searchsorted(parts[order], np.arange(n_jobs + 1))
+    tasks = [
+        (user_ids[order[lo:hi]], day_numbers[order[lo:hi]], days)
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=pool_context()) as pool:
+        states = list(pool.map(_build_partition, tasks))
+    state = RetentionState.merge(states)
+    state.tz = tz
+    return state
+
+
+def parse_size(value):
+    # 536870912, '512MB', '2G' -> байты
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'не удалось разобрать объем памяти: {value!r}')
+    power = ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * 1024 ** power)
+
+
+def _spill_chunk(keys, spill_dir, n_partitions):
+    parts = partition_of(keys >> DAY_BITS, n_partitions)
+    order = np.argsort(parts, kind='stable')
+    bounds = np.searchsorted(parts[order], np.arange(n_partitions + 1))
+    for part, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if hi > lo:
+            with open(os.path.join(spill_dir, f'{part}.bin'), 'ab') as f:
+                keys[order[lo:hi]].tofile(f)
+
+
+def chunk_sizes(memory):
+    # Чанк собирается из целых блоков файла и может превысить chunk_size на один блок:
+    # четверть памяти - на блок, остальное - на chunk_size (в записях)
+    records = memory // RAW_RECORD_BYTES
+    block_records = records // 4
+    chunk_size = min(CHUNK_SIZE * 10, records - block_records)
+    if chunk_size < MIN_CHUNK_RECORDS:
+        raise ValueError(f'бюджет памяти слишком мал для чтения выгрузки чанками '
+                         f'(в чанк помещается меньше {MIN_CHUNK_RECORDS} записей)')
+    return chunk_size, max(1 << 12, min(READ_BLOCK_SIZE, block_records * JSON_RECORD_BYTES))
+
+
+def _collect_users(spill_dir, parts, n_users):
+    # Массивы по пользователям из партиций (на диске) -> один набор, отсортированный по telegram_id.
+    # Пользователь и первый день упакованы в один ключ, как пары: пик - USER_RESULT_BYTES на пользователя
+    def concatenated(row):
+        result = np.empty(n_users, dtype=np.int64)
+        pos = 0
+        for part in parts:
+            values = np.load(os.path.join(spill_dir, f'{part}.users.npy'), mmap_mode='r')[row]
+            result[pos:pos + len(values)] = values
+            pos += len(values)
+        return result
+
+    keys = concatenated(0)
+    order = np.argsort(keys)
+    keys = keys[order]
+    purchase_count = concatenated(1)[order]
+    del order
+    user_ids, first_day = unpack_pairs(keys)
+    return user_ids, first_day, purchase_count
+
+
+def build_state_chunked(paths, memory_budget, days=DEFAULT_DAYS, tz=None, datetime_format=DATETIME_FORMAT):
+    # Режим для логов больше памяти. Проход 1: события читаются чанками, счетчики по событиям
+    # копятся в памяти, а пары (пользователь, день) каждого события сбрасываются на диск в
+    # хэш-партиции по telegram_id. Проход 2: каждая партиция целиком помещается в бюджет,
+    # по ней строится состояние; счетчики когорт и дней складываются, а массивы по
+    # пользователям партиции уходят на диск и в конце собираются в один отсортированный набор.
+    # Бюджет - рабочая память сверх интерпретатора и библиотек: чанк, партиция и итоговые
+    # массивы по пользователям (если они в него не помещаются - ValueError).
+    # Пары пользователь-день в итоговом состоянии не хранятся (для дальнейших
+    # инкрементальных обновлений используйте обычный RetentionState).
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    budget = int(parse_size(memory_budget) * BUDGET_SHARE)
+    max_events = sum(os.path.getsize(path) for path in paths) // JSON_RECORD_BYTES + 1
+    # Несколько выгрузок с пересекающимися окнами: события с id из предыдущих файлов
+    # пропускаются; отсортированные id держатся в памяти весь проход 1
+    seen_bytes = max_events * SEEN_ID_BYTES if len(paths) > 1 else 0
+    chunk_size, block_size = chunk_sizes(budget // 2 - seen_bytes)
+    n_partitions = max(1, -(-max_events * PARTITION_EVENT_BYTES // budget))
+
+    counters = empty_counters()
+    state = RetentionState(days, tz=tz)
+    seen = np.zeros(0, dtype=np.int64)
+    with tempfile.TemporaryDirectory(prefix='retention_spill_') as spill_dir:
+        for path in paths:
+            file_ids = []
+            for chunk in iter_event_chunks(path, chunk_size=chunk_size, tz=tz, datetime_format=datetime_format,
+                                           block_size=block_size):
+                # Сначала отбрасываются записи без даты: их id не должен закрывать
+                # разобранную копию события в следующем файле
+                chunk = add_dates(chunk)
+                if len(paths) > 1:
+                    chunk = drop_seen(chunk, seen)
+                    file_ids.append(chunk['id'].values)
+                add_counters(counters, event_counters(chunk))
+                keys = pack_pairs(chunk['telegram_id'].values, to_day_numbers(chunk['date']), unique=False)
+                del chunk
+                _spill_chunk(keys, spill_dir, n_partitions)
+            if file_ids:
+                seen = add_seen(seen, np.concatenate(file_ids))
+        del seen
+
+        parts = []
+        n_users = 0
+        for part in range(n_partitions):
+            spill_file = os.path.join(spill_dir, f'{part}.bin')
+            if not os.path.exists(spill_file):
+                continue
+            keys = np.fromfile(spill_file, dtype=np.int64)
+            os.remove(spill_file)
+            users, day_numbers = unpack_pairs(keys)
+            del keys
+            partial = RetentionState(days).update_arrays(users, day_numbers)
+            del users, day_numbers
+            state.cohort_counts = combine(state.cohort_counts, partial.cohort_counts)
+            state.daily = combine(state.daily, partial.daily)
+            n_users += len(partial.user_ids)
+            if n_users * USER_RESULT_BYTES > budget:
+                raise ValueError(f'бюджет памяти {memory_budget} меньше итоговых массивов по пользователям '
+                                 f'(больше {n_users} пользователей по {USER_RESULT_BYTES} байт)')
+            np.save(os.path.join(spill_dir, f'{part}.users.npy'),
+                    np.stack([pack_pairs(partial.user_ids, partial.first_day, unique=False), partial.purchase_count]))
+            parts.append(part)
+            del partial
+
+        state.user_ids, state.first_day, state.purchase_count = _collect_users(spill_dir, parts, n_users)
+
+    state.event_counts = counters
+    return state
+
+
+def ingest_files(state, paths):
+    # Уже учтенные файлы (по хэшу содержимого) пропускаются, поэтому повторный запуск безопасен
+    ingested = []
+    for path in paths:
+        digest = content_hash(path)
+        if state.is_ingested(digest):
+            continue
+        state.update(load_events(path, tz=state.tz))
+        state.sources.append({'path': os.path.abspath(path), 'content_hash': digest})
+        ingested.append(path)
+    return ingested
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Инкрементальное обновление когорт и retention новыми выгрузками')
+    parser.add_argument('state', help='файл состояния (.npz), создается при первом запуске')
+    parser.add_argument('files', nargs='+', help='выгрузки user_logs_paid_*.json')
+    parser.add_argument('--tz', default=None, help='отчетный часовой пояс для нового состояния')
+    parser.add_argument('--days', type=int, nargs='+', default=list(DEFAULT_DAYS))
+    args = parser.parse_args()
+
+    if os.path.exists(args.state):
+        state = RetentionState.load(args.state)
+    else:
+        state = RetentionState(args.days, tz=args.tz)
+
+    ingested = ingest_files(state, args.files)
+    state.save(args.state)
+
+    user_purchases, _ = state.repeat_purchases()
+    print(f'Новых файлов: {len(ingested)}, всего источников: {len(state.sources)}')
+    print(f'Уникальных пользователей: {len(state.user_ids)}')
+    for day, data in state.rolling_retention().items():
+        print(f'Средний Retention Day {day[4:]}: {data.iloc[:, 1].mean():.2f}%')
+    if len(user_purchases):
+        print(f'Повторные покупки: {(user_purchases["purchase_count"] > 1).mean() * 100:.1f}%')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from retention_engine import PURCHASE_BINS, PURCHASE_LABELS
+
+# Сегментный retention за один проход: пользователь относится к одному сегменту (по признакам
+# первой покупки), все метрики считаются bincount-ами по номеру сегмента, без фильтрации
+# таблицы и повторного запуска анализа на каждый сегмент.
+# Ключи: 'cohort_month', 'cohort_week', 'first_weekday', любая колонка таблицы событий
+# (значение в первой покупке пользователя, например 'sub_name') или pd.Series с сегментом
+# по telegram_id.
+DERIVED_KEYS = ('cohort_month', 'cohort_week', 'first_weekday')
+
+
+def user_segments(features, keys):
+    # Значения ключей для каждого пользователя в порядке features.user_ids
+    columns = {}
+    for i, key in enumerate(keys):
+        if isinstance(key, pd.Series):
+            columns[key.name or f'segment_{i}'] = key.reindex(features.user_ids).values
+        elif key == 'cohort_month':
+            columns[key] = features.user_cohort_month.array
+        elif key == 'cohort_week':
+            columns[key] = features.first_purchase_date.dt.to_period('W').array
+        elif key == 'first_weekday':
+            columns[key] = features.first_purchase_date.dt.day_name().values
+        elif key in features.events.columns:
+            columns[key] = features.events[key].iloc[features.first_event].values
+        else:
+            raise ValueError(f'неизвестный ключ сегмента {key!r}: ожидается колонка таблицы событий, '
+                             f'один из {DERIVED_KEYS} или pd.Series по telegram_id')
+    return pd.DataFrame(columns, index=features.user_ids)
+
+
+def segmented_retention(features, keys=('sub_name',), days=(1, 7, 30)):
+    # Одна строка на сегмент: пользователи, покупки, распределение по числу покупок (% пользователей),
+    # retention_day_N - средний rolling retention по дням (как в calculate_rolling_retention),
+    # cohort_day_N - % пользователей сегмента, активных ровно через N дней после первой покупки
+    if isinstance(keys, (str, pd.Series)):
+        keys = [keys]
+    if not len(keys):
+        raise ValueError('нужен хотя бы один ключ сегмента')
+    segments = user_segments(features, keys)
+    groups = segments.groupby(list(segments.columns), sort=True, observed=True, dropna=False)
+    segment = groups.ngroup().values
+    index = groups.size().index
+    n_segments = len(index)
+
+    purchase_count = features.purchase_count.values
+    users = np.bincount(segment, minlength=n_segments)
+    purchases = np.bincount(segment, weights=purchase_count, minlength=n_segments).astype(np.int64)
+    result = {
+        'users': users,
+        'purchases': purchases,
+        'purchases_per_user': purchases / users,
+        'repeat_rate': np.bincount(segment, weights=purchase_count > 1, minlength=n_segments) / users * 100,
+    }
+    categories = pd.cut(purchase_count, bins=PURCHASE_BINS, labels=False)
+    by_category = np.bincount(segment * len(PURCHASE_LABELS) + categories,
+                              minlength=n_segments * len(PURCHASE_LABELS)).reshape(n_segments, -1)
+    for i, label in enumerate(PURCHASE_LABELS):
+        result[label] = by_category[:, i] / users * 100
+
+    # Пары пользователь-день: ключ (day - first_day) * n_users + user_code, коды - как у features.user_ids
+    keys, n_users, first_day = features.pair_keys
+    pair_users = keys % n_users
+    pair_days = keys // n_users
+    pair_segments = segment[pair_users]
+    offsets = pair_days + first_day - features.first_day[pair_users]
+    n_days = int(pair_days.max()) + 1 if len(keys) else 1
+    cell = pair_segments * n_days + pair_days
+    active = np.bincount(cell, minlength=n_segments * n_days).reshape(n_segments, n_days)
+
+    for day in days:
+        targets = keys + int(day) * n_users
+        pos = np.searchsorted(keys, targets)
+        hit = pos < len(keys)
+        hit[hit] = keys[pos[hit]] == targets[hit]
+        retained = np.bincount(cell[hit], minlength=n_segments * n_days).reshape(n_segments, n_days)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily = np.where(active > 0, retained / active * 100, np.nan)
+            # Среднее по дням, в которые в сегменте были покупки
+            result[f'retention_day_{day}'] = np.nansum(daily, axis=1) / (active > 0).sum(axis=1)
+        result[f'cohort_day_{day}'] = np.bincount(pair_segments[offsets == day], minlength=n_segments) / users * 100
+
+    return pd.DataFrame(result, index=index)
@@ -0,0 +1,127 @@
+import argparse
+import json
+import math
+
+import numpy as np
+
+# Генератор синтетических выгрузок в формате user_logs_paid_*.json. Распределения сняты
+# с реальной выгрузки user_logs_paid_241024_250909.json: число покупок на пользователя,
+# доли тарифов, часы и дни недели покупок, интервалы между продлениями.
+PURCHASE_COUNT_PROBS = np.array([0.665, 0.1675, 0.087, 0.0367, 0.0168, 0.0103, 0.009, 0.0058, 0.0013, 0.0006])
+SUB_NAMES = ['30 дней', '90 дней', '365 дней            ', '180 дней            ']
+SUB_DAYS = np.array([30, 90, 365, 180])
+SUB_PROBS = np.array([0.9138, 0.0728, 0.013, 0.0004])
+HOUR_PROBS = np.array([0.04, 0.018, 0.012, 0.005, 0.003, 0.004, 0.005, 0.012, 0.021, 0.037, 0.05, 0.059,
+                       0.068, 0.066, 0.089, 0.075, 0.073, 0.059, 0.057, 0.048, 0.048, 0.049, 0.045, 0.055])
+WEEKDAY_PROBS = np.array([0.151, 0.181, 0.171, 0.147, 0.135, 0.115, 0.101])
+# Продления почти всегда приходят как 'extended', первые покупки - как 'paid'
+REPEAT_EXTENDED_SHARE = 0.99
+FIRST_EXTENDED_SHARE = 0.012
+RENEWAL_LAG_DAYS = 8.0
+
+MEAN_PURCHASES = float((PURCHASE_COUNT_PROBS / PURCHASE_COUNT_PROBS.sum() * np.arange(1, 11)).sum())
+USER_CHUNK = 200_000
+TELEGRAM_ID_RANGE = (100_000_000, 8_000_000_000)
+
+
+def generate_events(n_events, start='2024-10-24', days=320, utc_offset='+03:00', seed=0):
+    # Чанки событий (dict колонок numpy); пользователи генерируются пачками, поэтому
+    # события внутри файла не отсортированы по времени (загрузчик сортирует сам)
+    rng = np.random.default_rng(seed)
+    count_probs = PURCHASE_COUNT_PROBS / PURCHASE_COUNT_PROBS.sum()
+    weekday_probs = WEEKDAY_PROBS / WEEKDAY_PROBS.sum()
+    hour_probs = HOUR_PROBS / HOUR_PROBS.sum()
+    start_day = np.datetime64(start, 'D')
+    start_weekday = (start_day.astype(np.int64) + 3) % 7
+    # Пользователь номер k получает id lo + (k * step + shift) mod span: step взаимно прост
+    # со span, поэтому id не повторяются ни внутри пачки, ни между пачками
+    id_low, id_high = TELEGRAM_ID_RANGE
+    id_span = id_high - id_low
+    id_step = int(rng.integers(id_span // 3, id_span))
+    while math.gcd(id_step, id_span) != 1:
+        id_step += 1
+    id_shift = int(rng.integers(id_span))
+
+    emitted = 0
+    users_made = 0
+    while emitted < n_events:
+        n_users = max(1, min(USER_CHUNK, int((n_events - emitted) / MEAN_PURCHASES) + 1))
+        counts = rng.choice(np.arange(1, 11), size=n_users, p=count_probs)
+        counts = counts[:np.searchsorted(np.cumsum(counts), n_events - emitted, side='right') + 1]
+        counts[-1] -= max(0, counts.sum() - (n_events - emitted))
+        counts = counts[counts > 0]
+        n_users, total = len(counts), int(counts.sum())
+
+        user_numbers = np.arange(users_made, users_made + n_users, dtype=np.int64)
+        users = id_low + (user_numbers * id_step + id_shift) % id_span
+        users_made += n_users
+        owner = np.repeat(np.arange(n_users), counts)
+        is_first = np.r_[True, owner[1:] != owner[:-1]]
+        plan = rng.choice(len(SUB_NAMES), size=total, p=SUB_PROBS / SUB_PROBS.sum())
+        # Следующая покупка - после окончания предыдущего тарифа с задержкой продления
+        gap = SUB_DAYS[np.r_[0, plan[:-1]]] + rng.exponential(RENEWAL_LAG_DAYS, size=total) - 2
+        gap = np.where(is_first, 0, np.maximum(gap, 0)).round().astype(np.int64)
+        starts = np.flatnonzero(is_first)
+        offset = np.cumsum(gap)
+        offset -= np.repeat(offset[starts], counts)
+
+        # Вся история пользователя укладывается в окно [start, start + days)
+        span = offset[np.r_[starts[1:], total] - 1]
+        first_day = (rng.random(n_users) * (np.maximum(days - 1 - span, 0) + 1)).astype(np.int64)
+        scale = np.where(span > days - 1, (days - 1) / np.maximum(span, 1), 1.0)
+        day = first_day[owner] + (offset * scale[owner]).astype(np.int64)
+        # Сдвиг в пределах +-3 дней дает распределение по дням недели как в реальных данных
+        weekday = (day + start_weekday) % 7
+        target = rng.choice(7, size=total, p=weekday_probs)
+        day = np.clip(day + (target - weekday + 3) % 7 - 3, 0, days - 1)
+
+        seconds = rng.choice(24, size=total, p=hour_probs) * 3600 + rng.integers(0, 3600, size=total)
+        moments = (start_day + day).astype('datetime64[s]') + seconds
+        action = np.where(rng.random(total) < np.where(is_first, FIRST_EXTENDED_SHARE, REPEAT_EXTENDED_SHARE),
+                          'extended', 'paid')
+
+        yield {
+            'id': np.arange(emitted + 1, emitted + total + 1),
+            'datetime': np.char.add(np.datetime_as_string(moments, unit='s'), utc_offset),
+            'telegram_id': users[owner],
+            'action': action,
+            'sub_name': np.array(SUB_NAMES)[plan],
+        }
+        emitted += total
+
+
+def write_events(path, n_events, **kwargs):
+    # Потоковая запись JSON-массива: память ограничена одной пачкой пользователей
+    sub_names = {name: json.dumps(name, ensure_ascii=False) for name in SUB_NAMES}
+    first = True
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        for chunk in generate_events(n_events, **kwargs):
+            lines = [
+                f'  {{"id": {i}, "datetime": "{dt}", "telegram_id": {tid}, '
+                f'"action": "{action}", "sub_name": {sub_names[sub]}}}'
+                for i, dt, tid, action, sub in zip(
+                    chunk['id'].tolist(), chunk['datetime'].tolist(), chunk['telegram_id'].tolist(),
+                    chunk['action'].tolist(), chunk['sub_name'].tolist())
+            ]
+            if not first:
+                f.write(',\n')
+            f.write(',\n'.join(lines))
+            first = False
+        f.write('\n]\n')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетическая выгрузка событий оплат')
+    parser.add_argument('output', help='путь к создаваемому .json')
+    parser.add_argument('--events', type=float, default=1e5, help='число событий (1e3 .. 1e8)')
+    parser.add_argument('--start', default='2024-10-24')
+    parser.add_argument('--days', type=int, default=320, help='длина периода выгрузки, дней')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_events(args.output, int(args.events), start=args.start, days=args.days, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# Модули проекта лежат в корне репозитория
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from event_loader import load_events  # noqa: E402
+
+EXPORT = os.path.join(ROOT, 'user_logs_paid_241024_250909.json')
+
+
+@pytest.fixture(scope='session')
+def export_path():
+    return EXPORT
+
+
+@pytest.fixture(scope='session')
+def events():
+    # Все записи выгрузки (ISO8601 - включая записи с дробными секундами)
+    return load_events(EXPORT, datetime_format='ISO8601')
+
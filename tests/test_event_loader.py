@@ -0,0 +1,79 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from event_loader import iter_records, load_events, parse_datetimes
+
+FORMATS = ['%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f%z', 'ISO8601']
+
+# Строки, которые быстрый путь должен разобрать или отдать pd.to_datetime так же, как он сам
+EDGE_CASES = [
+    '2025-01-31T23:59:59+03:00', '2025-01-31T23:59:59.5+03:00', '2025-01-31T23:59:59.123456-05:30',
+    '2025-01-31T23:59:59.1234567+03:00', '2024-02-29T12:00:00+00:00', '2025-02-29T12:00:00+00:00',
+    '2025-02-30T12:00:00+03:00', '2025-13-01T00:00:00+03:00', '2025-01-01T24:00:00+03:00',
+    '2025-01-01T23:59:60+03:00', '2025-01-01T12:00:00Z', '2025-01-01T12:00:00+0300',
+    '2025-01-01 12:00:00+03:00', '2025-01-01T12:00:00', '1600-01-01T00:00:00+00:00',
+    '2262-04-11T23:47:16+00:00', '1677-09-21T00:12:44+00:00', '2025-1-01T12:00:00+03:00',
+    '2025-01-01T12:00:00+25:00', '', 'not a date', None,
+]
+
+
+def reference_parse(values, datetime_format):
+    return pd.to_datetime(pd.Series(values, dtype=object), format=datetime_format,
+                          errors='coerce', utc=True).dt.as_unit('us')
+
+
+def assert_same_instants(result, expected):
+    assert list(result.isna()) == list(expected.isna())
+    assert list(result.dropna().values) == list(expected.dropna().values)
+
+
+@pytest.mark.parametrize('datetime_format', FORMATS)
+def test_matches_pandas_on_export(export_path, datetime_format):
+    values = [record.get('datetime') for record in iter_records(export_path)]
+    assert_same_instants(parse_datetimes(values, datetime_format), reference_parse(values, datetime_format))
+
+
+@pytest.mark.parametrize('datetime_format', FORMATS)
+@pytest.mark.parametrize('value', EDGE_CASES)
+def test_matches_pandas_on_edge_cases(datetime_format, value):
+    # Одиночная строка и она же среди обычных записей (быстрый путь работает по всему чанку)
+    values = [value, '2025-01-31T23:59:59+03:00', '2025-01-31T23:59:59.25+03:00']
+    assert_same_instants(parse_datetimes(values[:1], datetime_format), reference_parse(values[:1], datetime_format))
+    assert_same_instants(parse_datetimes(values, datetime_format), reference_parse(values, datetime_format))
+
+
+def test_matches_pandas_on_random_strings():
+    rng = np.random.default_rng(0)
+    moments = rng.integers(-2_000_000_000, 4_000_000_000, size=2000).astype('datetime64[s]')
+    offsets = rng.choice(['+03:00', '-05:30', '+00:00', 'Z', '+0300'], size=len(moments))
+    fractions = rng.choice(['', '.5', '.123', '.123456', '.1234567'], size=len(moments))
+    values = [f'{str(moment)}{fraction}{offset}' for moment, fraction, offset in zip(moments, fractions, offsets)]
+    for datetime_format in FORMATS:
+        assert_same_instants(parse_datetimes(values, datetime_format), reference_parse(values, datetime_format))
+
+
+def test_load_events_matches_pandas_loader(export_path):
+    # Прежний load_data: json.load, DataFrame и pd.to_datetime с форматом по первой записи
+    with open(export_path, encoding='utf-8') as f:
+        df = pd.DataFrame(json.load(f))
+    df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
+    df = df.dropna(subset=['datetime']).sort_values(['datetime', 'id'])
+
+    # Порядок событий с одинаковым временем не задан - сравнение по (datetime, id)
+    events = load_events(export_path).sort_values(['datetime', 'id'])
+    assert list(events['id']) == list(df['id'])
+    assert list(events['datetime'].values) == list(df['datetime'].dt.tz_convert('UTC').dt.tz_localize(None).values)
+    assert list(events['sub_name'].astype(str)) == list(df['sub_name'])
+
+
+@pytest.mark.parametrize('column', ['id', 'telegram_id'])
+def test_null_ids_are_rejected(tmp_path, column):
+    record = {'id': 1, 'datetime': '2025-01-01T12:00:00+03:00', 'telegram_id': 7, 'action': 'paid',
+              'sub_name': '30 дней'}
+    path = tmp_path / 'export.json'
+    path.write_text(json.dumps([record, {**record, 'id': 2, column: None}]), encoding='utf-8')
+    with pytest.raises(ValueError, match=f'{column}=None'):
+        load_events(str(path))
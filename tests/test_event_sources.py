@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal
+
+from event_loader import load_events
+from event_sources import load_sources, source_format
+from retention_state import RetentionState, build_state_chunked
+from sketches import build_cohort_sketch, build_cohort_sketch_chunked
+
+# Пересекающиеся окна выгрузки: первый файл начинается с записи без дробных секунд,
+# следующие - с записей с дробными секундами
+WINDOWS = [(0, 1500), (1386, 2200), (2000, None)]
+
+
+@pytest.fixture(scope='module')
+def export_files(export_path, tmp_path_factory):
+    with open(export_path, encoding='utf-8') as f:
+        records = json.load(f)
+    directory = tmp_path_factory.mktemp('exports')
+    paths = []
+    for number, (start, stop) in enumerate(WINDOWS):
+        path = directory / f'user_logs_paid_{number:03d}.json'
+        path.write_text(json.dumps(records[start:stop], ensure_ascii=False), encoding='utf-8')
+        paths.append(str(path))
+    return paths
+
+
+def test_format_resolved_once(export_files, export_path):
+    # Формат выводится по первой записи первого файла и общий для всех, как у одной выгрузки
+    assert source_format(export_files) == '%Y-%m-%dT%H:%M:%S%z'
+    events = load_sources(export_files, use_cache=False, n_jobs=1)
+    expected = load_events(export_path)
+    assert len(events) == len(expected)
+    assert_frame_equal(events.sort_values('id').reset_index(drop=True)[['id', 'datetime', 'telegram_id']],
+                       expected.sort_values('id').reset_index(drop=True)[['id', 'datetime', 'telegram_id']])
+
+
+def test_explicit_format_is_kept(export_files, events):
+    merged = load_sources(export_files, use_cache=False, n_jobs=1, datetime_format='ISO8601')
+    assert len(merged) == len(events)
+
+
+def test_chunked_matches_in_memory(export_files):
+    events = load_sources(export_files, use_cache=False, n_jobs=1)
+    datetime_format = source_format(export_files)
+    full = RetentionState.from_events(events)
+    chunked = build_state_chunked(export_files, '64MB', datetime_format=datetime_format)
+    assert np.array_equal(chunked.user_ids, full.user_ids)
+    assert np.array_equal(chunked.purchase_count, full.purchase_count)
+    assert_frame_equal(chunked.cohort_data(), full.cohort_data())
+
+    sketch = build_cohort_sketch_chunked(export_files, datetime_format=datetime_format)
+    assert_frame_equal(sketch.cohort_data(), build_cohort_sketch(events).cohort_data())
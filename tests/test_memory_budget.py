@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+from conftest import EXPORT, ROOT
+from event_loader import load_events
+from retention_state import RetentionState, build_state_chunked, parse_size
+from synthetic_logs import write_events
+
+resource = pytest.importorskip('resource')
+
+# Пик RSS построения в отдельном процессе сверх уже прогретого интерпретатора: прогон на маленькой
+# выгрузке подгружает ленивые модули pandas, они не относятся к рабочей памяти режима
+PEAK_SCRIPT = '''
+import resource, sys
+from retention_state import build_state_chunked
+build_state_chunked(sys.argv[1], '64MB')
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+build_state_chunked(sys.argv[2], sys.argv[3])
+# ru_maxrss - в КБ, на macOS - в байтах
+print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * (1 if sys.platform == 'darwin' else 1024))
+'''
+
+
+@pytest.fixture(scope='module')
+def synthetic_export(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('exports') / 'user_logs_paid_synthetic.json')
+    write_events(path, 300_000, seed=1)
+    return path
+
+
+@pytest.mark.parametrize('budget', ['8MB', '32MB'])
+def test_peak_memory_within_budget(synthetic_export, budget):
+    output = subprocess.run([sys.executable, '-c', PEAK_SCRIPT, EXPORT, synthetic_export, budget],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert int(output.split()[-1]) <= parse_size(budget)
+
+
+def test_matches_in_memory_state(synthetic_export):
+    chunked = build_state_chunked(synthetic_export, '8MB')
+    full = RetentionState.from_events(load_events(synthetic_export))
+    np.testing.assert_array_equal(chunked.user_ids, full.user_ids)
+    np.testing.assert_array_equal(chunked.first_day, full.first_day)
+    np.testing.assert_array_equal(chunked.purchase_count, full.purchase_count)
+    assert_series_equal(chunked.cohort_counts, full.cohort_counts)
+    assert_frame_equal(chunked.daily, full.daily)
+    for name in full.event_counts:
+        assert_series_equal(chunked.event_counts[name].sort_index(), full.event_counts[name].sort_index(),
+                            check_names=False)
+
+
+def test_too_small_budget_is_rejected(synthetic_export):
+    with pytest.raises(ValueError, match='бюджет памяти'):
+        build_state_chunked(synthetic_export, '1MB')
+    with pytest.raises(ValueError, match='итоговых массивов'):
+        build_state_chunked(synthetic_export, '6MB')
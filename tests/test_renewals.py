@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from event_features import EventFeatures
+from renewals import GRACE_DAYS, SECONDS_PER_DAY, STATUSES, renewal_events
+
+
+def reference_statuses(df, grace_days):
+    # Перебор покупок каждого пользователя: срок продлевается с конца текущего покрытия,
+    # следующая покупка - первая строго позже текущей
+    seconds = df['datetime'].values.astype('datetime64[s]').astype(np.int64)
+    plan = df['sub_name'].astype(str).str.extract(r'(\d+)', expand=False).astype(int).values
+    observed_until = seconds.max()
+    grace = grace_days * SECONDS_PER_DAY
+    rows = []
+    for user in sorted(set(df['telegram_id'])):
+        mine = sorted((seconds[i], plan[i]) for i in np.flatnonzero(df['telegram_id'].values == user))
+        end = None
+        for i, (moment, days) in enumerate(mine):
+            end = max(moment, end if end is not None else moment) + days * SECONDS_PER_DAY
+            later = [other for other, _ in mine[i + 1:] if other > moment]
+            if later and later[0] <= end:
+                status = 'on_time'
+            elif later and later[0] <= end + grace:
+                status = 'grace'
+            elif later or end + grace <= observed_until:
+                status = 'churned'
+            else:
+                status = 'open'
+            rows.append((user, moment, end, status))
+    return pd.DataFrame(rows, columns=['telegram_id', 'seconds', 'coverage_end', 'status'])
+
+
+@pytest.mark.parametrize('grace_days', [0, GRACE_DAYS, 30])
+def test_statuses_match_per_user_loop(events, grace_days):
+    expected = reference_statuses(events, grace_days)
+    result = renewal_events(EventFeatures(events), grace_days=grace_days)
+    assert list(result['telegram_id']) == list(expected['telegram_id'])
+    assert list(result['datetime'].values.astype('datetime64[s]').astype(np.int64)) == list(expected['seconds'])
+    assert list(result['coverage_end'].values.astype('datetime64[s]').astype(np.int64)) == \
+        list(expected['coverage_end'])
+    assert list(result['status'].astype(str)) == list(expected['status'])
+    assert set(result['status'].cat.categories) == set(STATUSES)
@@ -0,0 +1,13 @@
+from retention_analysis import RetentionAnalyzer
+
+
+def test_invalidate_after_in_place_edit(export_path):
+    analyzer = RetentionAnalyzer(export_path, use_cache=False)
+    users = analyzer.features.purchase_count
+    user = users.index[0]
+    # Все покупки первого пользователя переписываются на второго
+    analyzer.df.loc[analyzer.df['telegram_id'] == user, 'telegram_id'] = users.index[1]
+    analyzer.invalidate()
+    purchase_count = analyzer.features.purchase_count
+    assert user not in purchase_count.index
+    assert purchase_count[users.index[1]] == users[user] + users[users.index[1]]
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from event_features import EventFeatures
+from retention_engine import rolling_retention, to_day_numbers
+from retention_state import RetentionState
+
+
+def reference_cohorts(df):
+    # Прежний полный пересчет calculate_cohort_retention: merge первой покупки и nunique
+    first_purchase = df.groupby('telegram_id')['date'].min().reset_index()
+    first_purchase.columns = ['telegram_id', 'first_purchase_date']
+    df_with_cohort = df.merge(first_purchase, on='telegram_id')
+    df_with_cohort['days_since_first'] = (df_with_cohort['date'] - df_with_cohort['first_purchase_date']).dt.days
+    df_with_cohort['cohort_month'] = df_with_cohort['first_purchase_date'].dt.to_period('M')
+    cohort_data = df_with_cohort.groupby(['cohort_month', 'days_since_first'])['telegram_id'].nunique().reset_index()
+    cohort_data.columns = ['cohort_month', 'period', 'users']
+    cohort_pivot = cohort_data.pivot(index='cohort_month', columns='period', values='users').fillna(0)
+    return cohort_pivot.div(cohort_pivot.iloc[:, 0], axis=0) * 100, cohort_pivot
+
+
+def check_full_recompute(state, df):
+    matrix, pivot = state.cohort_retention()
+    expected_matrix, expected_pivot = reference_cohorts(df)
+    assert_frame_equal(pivot, expected_pivot, check_dtype=False, check_names=False)
+    assert_frame_equal(matrix, expected_matrix, check_dtype=False, check_names=False)
+
+    purchases = df.groupby('telegram_id').size()
+    user_purchases, _ = state.repeat_purchases()
+    assert list(user_purchases['telegram_id']) == list(purchases.index)
+    assert list(user_purchases['purchase_count']) == list(purchases.values)
+
+    expected = rolling_retention(df['telegram_id'].values, to_day_numbers(df['date']), state.days)
+    result = state.rolling_retention()
+    for key in expected:
+        assert_frame_equal(result[key], expected[key])
+
+    assert dict(state.event_counts['sub_name']) == dict(df['sub_name'].astype(str).value_counts())
+
+
+def test_out_of_order_batches_match_full_recompute(events, tmp_path):
+    # Пачки в обратном хронологическом порядке: опоздавшие события сдвигают первую покупку
+    batches = np.array_split(np.arange(len(events)), 6)
+    state = RetentionState()
+    for i, rows in enumerate(reversed(batches)):
+        state.update(events.iloc[rows])
+        if i == 2:
+            state.save(str(tmp_path / 'state.npz'))
+            state = RetentionState.load(str(tmp_path / 'state.npz'))
+    check_full_recompute(state, events)
+
+
+def test_random_batches_match_full_recompute(events):
+    parts = np.random.default_rng(0).integers(0, 5, len(events))
+    state = RetentionState()
+    for part in range(5):
+        state.update(events[parts == part])
+    check_full_recompute(state, events)
+
+
+def test_repeated_events_are_counted_once(events):
+    # Пересекающиеся выгрузки: события с уже учтенным id пропускаются
+    half = len(events) // 2
+    state = RetentionState()
+    state.update(events.iloc[:half + 100])
+    state.update(events.iloc[half - 100:])
+    check_full_recompute(state, events)
+
+
+def test_merge_of_user_partitions(events):
+    odd = (events['telegram_id'] % 2).values.astype(bool)
+    state = RetentionState.merge([RetentionState.from_events(events[odd]),
+                                  RetentionState.from_events(events[~odd])])
+    check_full_recompute(state, events)
+    assert pd.Index(state.user_ids).is_monotonic_increasing
+
+
+def test_subscription_counts_of_filtered_events(events):
+    # Выборка по одному тарифу: категории без событий не попадают в статистику, как и в состоянии
+    subset = events[events['sub_name'] == '30 дней']
+    sub_stats = EventFeatures(subset).sub_stats
+    assert dict(sub_stats) == {'30 дней': len(subset)}
+    assert dict(sub_stats) == dict(RetentionState.from_events(subset).subscription_patterns()[0])
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from retention_engine import rolling_retention, to_day_numbers
+
+DAYS = [1, 7, 30]
+
+
+def reference_rolling_retention(df, days):
+    # Прежний построчный перебор дат из calculate_rolling_retention
+    results = {}
+    for day in days:
+        daily_retention = []
+        dates = []
+        for current_date in sorted(df['date'].unique()):
+            users_today = set(df[df['date'] == current_date]['telegram_id'])
+            check_date = current_date + timedelta(days=day)
+            users_check_date = set(df[df['date'] == check_date]['telegram_id'])
+            daily_retention.append(len(users_today & users_check_date) / len(users_today) * 100)
+            dates.append(current_date)
+        results[f'day_{day}'] = pd.DataFrame({'date': dates, f'retention_day_{day}': daily_retention})
+    return results
+
+
+def test_matches_per_date_loop(events):
+    expected = reference_rolling_retention(events, DAYS)
+    result = rolling_retention(events['telegram_id'].values, to_day_numbers(events['date']), DAYS)
+    for day in DAYS:
+        key, column = f'day_{day}', f'retention_day_{day}'
+        assert list(result[key]['date']) == list(pd.to_datetime(expected[key]['date']))
+        np.testing.assert_allclose(result[key][column].values, expected[key][column].values)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_per_date_loop_on_shuffled_sample(events, seed):
+    # Порядок строк и повторы покупок в один день не влияют на результат
+    sample = events.sample(frac=0.5, random_state=seed)
+    expected = reference_rolling_retention(sample, DAYS)
+    result = rolling_retention(sample['telegram_id'].values, to_day_numbers(sample['date']), DAYS)
+    for day in DAYS:
+        column = f'retention_day_{day}'
+        np.testing.assert_allclose(result[f'day_{day}'][column].values, expected[f'day_{day}'][column].values)